@@ -0,0 +1,78 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import statistics
+import time
+from typing import Dict, List
+
+parser = argparse.ArgumentParser(description="send_photo fan-out benchmarki: standart AiohttpSession va TunedAiohttpSession alohida jarayondagi soxta Bot API serverida.")
+parser.add_argument("--messages", type=int, default=5000, help="Yuboriladigan xabarlar soni")
+parser.add_argument("--concurrency", type=int, default=200, help="Bir vaqtdagi so'rovlar (ikkala sessiya uchun bir xil)")
+parser.add_argument("--latency-ms", type=float, default=30.0, help="Soxta server javob kechikishi")
+parser.add_argument("--jitter-ms", type=float, default=10.0, help="Kechikishga qo'shiladigan tasodifiy qism")
+parser.add_argument("--port", type=int, default=8081, help="Soxta Bot API server porti")
+parser.add_argument("--rounds", type=int, default=3, help="Har bir sessiya uchun takrorlar (sessiyalar navbatma-navbat ishlaydi)")
+args = parser.parse_args()
+
+from cryptography.fernet import Fernet
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH-fake-token"); os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("METRICS_ENABLED", "False")
+
+import bot_postgress_sql as app
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+def create_fake_api(latency_ms: float, jitter_ms: float) -> web.Application:
+    async def handle(request: web.Request) -> web.Response:
+        await asyncio.sleep((latency_ms + random.random() * jitter_ms) / 1000)
+        data = await request.post(); chat_id = int(data.get("chat_id", 1))
+        return web.json_response({"ok": True, "result": {"message_id": random.randint(1, 10**9), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                                                         "photo": [{"file_id": "bench", "file_unique_id": "bench", "width": 1, "height": 1}]}})
+    fake_api = web.Application(); fake_api.router.add_post("/bot{token}/{method}", handle); return fake_api
+
+def serve_fake_api(port: int, latency_ms: float, jitter_ms: float): web.run_app(create_fake_api(latency_ms, jitter_ms), host="127.0.0.1", port=port, print=None, handle_signals=False)
+
+async def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try: _, writer = await asyncio.open_connection("127.0.0.1", port); writer.close(); await writer.wait_closed(); return
+        except OSError:
+            if time.monotonic() > deadline: raise
+            await asyncio.sleep(0.1)
+
+async def fan_out(session: BaseSession) -> List[float]:
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session); semaphore = asyncio.Semaphore(args.concurrency); latencies: List[float] = []
+    async def send(chat_id: int):
+        async with semaphore:
+            started = time.perf_counter(); await bot.send_photo(chat_id=chat_id, photo="bench", caption="Benchmark"); latencies.append(time.perf_counter() - started)
+    try: await asyncio.gather(*(send(1000 + i) for i in range(args.messages)))
+    finally: await bot.session.close()
+    return latencies
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples); return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000
+
+async def run():
+    server = multiprocessing.get_context("spawn").Process(target=serve_fake_api, args=(args.port, args.latency_ms, args.jitter_ms), daemon=True); server.start()
+    api = TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}")
+    sessions = {"AiohttpSession (standart)": lambda: AiohttpSession(api=api), "TunedAiohttpSession": lambda: app.TunedAiohttpSession(api=api)}
+    throughput: Dict[str, List[float]] = {name: [] for name in sessions}
+    try:
+        await wait_for_port(args.port)
+        print(f"{args.messages} ta send_photo, parallel={args.concurrency}, server kechikishi={args.latency_ms}+{args.jitter_ms} ms (server alohida jarayonda)\n")
+        print(f"{'sessiya':<28}{'xabar/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for _ in range(args.rounds):
+            for name, factory in sessions.items():
+                started = time.perf_counter(); latencies = await fan_out(factory()); elapsed = time.perf_counter() - started; throughput[name].append(len(latencies) / elapsed)
+                print(f"{name:<28}{throughput[name][-1]:>10.1f}{percentile(latencies, 0.5):>10.1f}{percentile(latencies, 0.99):>10.1f}")
+        print("\nMediana: " + ", ".join(f"{name}={statistics.median(values):.1f} xabar/s" for name, values in throughput.items()))
+    finally: server.terminate(); server.join()
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -1,34 +1,59 @@
 import asyncio
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import random
-from typing import List, Union, Dict, Optional, Callable, Any, Awaitable
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+from functools import lru_cache, partial
+from typing import List, Union, Dict, Optional, Callable, Any, Awaitable, Tuple, NamedTuple, AsyncIterator
 
 from aiogram import Bot, Dispatcher, F, BaseMiddleware, Router
 from aiogram.client.bot import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.redis import RedisStorage
-from aiogram.types import (Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, TelegramObject)
+from aiogram.types import (Update, Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, TelegramObject, Chat, ChatMemberUpdated)
 from aiogram.filters.command import CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.dispatcher.flags import get_flag
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import ClientConnectorError, web
 
-from sqlalchemy import (create_engine, Column, BigInteger, String, DateTime, ForeignKey, Integer, LargeBinary, UniqueConstraint, JSON, Boolean, Text, select, update, func)
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import (create_engine, Column, BigInteger, String, DateTime, ForeignKey, Integer, LargeBinary, UniqueConstraint, Index, JSON, Boolean, Text, MetaData, Table, select, update, insert, func, true, text, inspect)
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine, async_sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 import redis.asyncio as aioredis
-from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError as RedisResponseError, RedisError
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import SecretStr, Field
 from cryptography.fernet import Fernet, InvalidToken
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s")
 logger = logging.getLogger(__name__)
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ENV_FILE_PATH = os.path.join(BASE_DIR, '.env')
@@ -49,16 +74,107 @@ class Settings(BaseSettings):
     POSTGRES_PASSWORD: Optional[SecretStr] = None
     POSTGRES_HOST: Optional[str] = "localhost"
     POSTGRES_PORT: Optional[int] = 5432
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_WARMUP: bool = True
+    DB_POOL_STATS_LOG_SECONDS: int = 60
+    METRICS_ENABLED: bool = False
+    METRICS_PORT: int = 9100
+    METRICS_PROBE_SECONDS: int = 15
+    PG_STATEMENT_CACHE_SIZE: int = 100
+    PG_APPLICATION_NAME: str = "vote-bot"
+    PG_STATEMENT_TIMEOUT_MS: int = 0
+    
+    BOT_MODE: str = "polling"
+    WEBHOOK_BASE_URL: Optional[str] = None
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: Optional[SecretStr] = None
+    WEBHOOK_DROP_PENDING_UPDATES: bool = False
+    WEBAPP_HOST: str = "0.0.0.0"
+    WEBAPP_PORT: int = 8080
+    WEB_WORKERS: int = 1
+    UPDATE_QUEUE_ENABLED: bool = False
+    UPDATE_QUEUE_PREFIX: str = "updates"
+    UPDATE_QUEUE_PARTITIONS: int = 16
+    UPDATE_QUEUE_BATCH_SIZE: int = 50
+    UPDATE_QUEUE_MAX_DELIVERIES: int = 5
+    UPDATE_QUEUE_LEASE_SECONDS: int = 15
+    UPDATE_QUEUE_STATS_LOG_SECONDS: int = 60
+    UPDATE_CONSUMERS: int = 2
     
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
     REDIS_PASSWORD: Optional[str] = None
     REDIS_DB_FSM: int = 0
     REDIS_DB_CAPTCHA: int = 1
+    REDIS_DB_CACHE: int = 2
+    FSM_STATE_TTL_SECONDS: int = 86400
+    FSM_DATA_TTL_SECONDS: int = 86400
+    
+    MEMBERSHIP_CACHE_TTL_MEMBER: int = 600
+    MEMBERSHIP_CACHE_TTL_NOT_MEMBER: int = 30
+    MEMBERSHIP_INDEX_ENABLED: bool = False
+    MEMBERSHIP_INDEX_MAX_AGE_SECONDS: int = 86400
+    MEMBERSHIP_INDEX_RECONCILE_INTERVAL_SECONDS: int = 3600
+    MEMBERSHIP_INDEX_RECONCILE_RATE: float = 10.0
+    MEMBERSHIP_INDEX_HEARTBEAT_SECONDS: int = 60
+    CHANNEL_INFO_REFRESH_SECONDS: int = 3600
+    
+    BROADCAST_RATE_PER_SECOND: float = 25.0
+    TELEGRAM_GLOBAL_RATE: float = 30.0
+    ADMIN_POLL_PAGE_SIZE: int = 10
+    TELEGRAM_CHAT_RATE: float = 1.0
+    TELEGRAM_CHAT_BURST: int = 3
+    TELEGRAM_RETRY_AFTER_ATTEMPTS: int = 1
+    TELEGRAM_API_URL: Optional[str] = None
+    TELEGRAM_HTTP_LIMIT: int = 200
+    TELEGRAM_HTTP_LIMIT_PER_HOST: int = 0
+    TELEGRAM_DNS_CACHE_SECONDS: int = 3600
+    TELEGRAM_KEEPALIVE_SECONDS: float = 60.0
+    TELEGRAM_REQUEST_TIMEOUT: float = 30.0
+    TELEGRAM_NETWORK_RETRIES: int = 2
+    TELEGRAM_RETRY_BACKOFF_SECONDS: float = 0.5
+    TELEGRAM_SLOW_CALL_MS: int = 2000
+    BROADCAST_CONCURRENCY: int = 20
+    BROADCAST_BATCH_SIZE: int = 500
+    BROADCAST_MAX_RETRIES: int = 3
+    BROADCAST_PROGRESS_INTERVAL_SECONDS: int = 10
+    
+    VOTE_COUNTERS_RECONCILE_SECONDS: int = 300
+    VOTE_WRITE_BEHIND_ENABLED: bool = False
+    VOTE_FLUSH_BATCH_SIZE: int = 500
+    VOTE_FLUSH_INTERVAL_MS: int = 500
+    VOTE_CLAIM_IDLE_MS: int = 60000
+    
+    KNOWN_USER_TTL_SECONDS: int = 86400
+    KNOWN_USER_LOCAL_TTL_SECONDS: int = 300
+    KNOWN_USER_LOCAL_MAX: int = 100000
     
     CAPTCHA_TIMEOUT_SECONDS: int = 60
     CAPTCHA_MAX_ATTEMPTS: int = 3
     CAPTCHA_BLOCK_DURATION_MINUTES: int = 5
+    THROTTLE_ENABLED: bool = True
+    THROTTLE_START_RATE: float = 0.2
+    THROTTLE_START_BURST: int = 3
+    THROTTLE_CALLBACK_RATE: float = 1.0
+    THROTTLE_CALLBACK_BURST: int = 5
+    THROTTLE_CAPTCHA_RATE: float = 0.5
+    THROTTLE_CAPTCHA_BURST: int = 3
+    THROTTLE_MESSAGE_RATE: float = 1.0
+    THROTTLE_MESSAGE_BURST: int = 5
+    THROTTLE_NOTICE_SECONDS: int = 10
+    
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 268435456
+    SQLITE_CACHE_SIZE: int = -64000
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_WRITE_TIMEOUT_SECONDS: int = 60
+    SQLITE_READ_POOL_SIZE: int = 4
+    SQLITE_READ_MAX_OVERFLOW: int = 16
     
     @property
     def ADMIN_IDS(self) -> List[int]: return [int(i.strip()) for i in self.ADMIN_IDS_STR.split(',') if i.strip()]
@@ -75,6 +191,8 @@ class Settings(BaseSettings):
             return f"sqlite+aiosqlite:///{os.path.join(BASE_DIR, self.SQLITE_DB_NAME)}"
         else:
             raise ValueError(f"Noto'g'ri DB_TYPE: '{self.DB_TYPE}'. Faqat 'sqlite' yoki 'postgresql' bo'lishi mumkin.")
+    @property
+    def SQLITE_READ_URL(self) -> str: return f"sqlite+aiosqlite:///file:{os.path.join(BASE_DIR, self.SQLITE_DB_NAME)}?mode=ro&uri=true"
 
     @property
     def REQUIRED_CHANNELS(self) -> List[Union[str, int]]:
@@ -93,6 +211,62 @@ try:
 except Exception as e:
     logger.critical(f".env faylini yuklashda xatolik: {e}. Majburiy maydonlarni tekshiring."); exit(1)
 
+try: import orjson
+except ImportError: orjson = None
+
+def fsm_json_dumps(data: Any) -> str: return orjson.dumps(data).decode() if orjson else json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+fsm_json_loads = orjson.loads if orjson else json.loads
+
+try: import prometheus_client
+except ImportError: prometheus_client = None
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs) -> "_NoopMetric": return self
+    def inc(self, amount: float = 1): pass
+    def set(self, value: float): pass
+    def observe(self, value: float): pass
+    def remove(self, *args): pass
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False; self.server_started = False
+        for name in ("handler_latency", "handler_errors", "throttled", "api_latency", "api_errors", "api_retry_after", "db_query_latency", "db_pool", "db_pool_wait", "redis_rtt",
+                     "api_queue_wait", "broadcast_messages", "broadcast_remaining", "captcha_outcomes", "update_queue"): setattr(self, name, _NoopMetric())
+    def setup(self):
+        if self.enabled or not settings.METRICS_ENABLED: return
+        if prometheus_client is None: logger.warning("METRICS_ENABLED=True, lekin prometheus_client o'rnatilmagan. Metrikalar o'chirildi."); return
+        from prometheus_client import Counter, Gauge, Histogram
+        self.handler_latency = Histogram("bot_handler_seconds", "Handler ishlash vaqti", ["handler"])
+        self.handler_errors = Counter("bot_handler_errors_total", "Handlerdagi xatolar", ["handler"])
+        self.throttled = Counter("bot_throttled_updates_total", "Cheklangan update'lar", ["action"])
+        self.api_latency = Histogram("bot_telegram_api_seconds", "Telegram API so'rovlari vaqti", ["method"])
+        self.api_errors = Counter("bot_telegram_api_errors_total", "Telegram API xatolari", ["method", "error"])
+        self.api_queue_wait = Histogram("bot_telegram_api_queue_seconds", "Telegram API navbatida kutish vaqti", ["priority"])
+        self.api_retry_after = Counter("bot_telegram_retry_after_total", "Telegram API RetryAfter javoblari", ["method"])
+        self.db_query_latency = Histogram("bot_db_query_seconds", "SQL so'rovlar vaqti", ["engine", "operation"])
+        self.db_pool = Gauge("bot_db_pool_connections", "DB havzasidagi ulanishlar", ["state"])
+        self.db_pool_wait = Gauge("bot_db_pool_wait_ms", "DB havzasidan ulanish kutish vaqti", ["stat"])
+        self.redis_rtt = Histogram("bot_redis_rtt_seconds", "Redis PING javob vaqti", buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25))
+        self.broadcast_messages = Counter("bot_broadcast_messages_total", "Reklama yuborish natijalari", ["status"])
+        self.broadcast_remaining = Gauge("bot_broadcast_remaining", "Reklama ishida qolgan foydalanuvchilar", ["job_id"])
+        self.captcha_outcomes = Counter("bot_captcha_outcomes_total", "CAPTCHA tekshiruvi natijalari", ["status"])
+        self.update_queue = Gauge("bot_update_queue", "Update navbati holati", ["stat"])
+        self.instrument_engine(engine, "write")
+        if read_engine is not engine: self.instrument_engine(read_engine, "read")
+        self.enabled = True
+    def instrument_engine(self, db_engine: AsyncEngine, name: str):
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if context is not None: context._query_started = time.perf_counter()
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = getattr(context, "_query_started", None)
+            if started is not None: self.db_query_latency.labels(name, statement.lstrip().split(None, 1)[0].upper()).observe(time.perf_counter() - started)
+        event.listen(db_engine.sync_engine, "before_cursor_execute", before_cursor_execute); event.listen(db_engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+    def start_server(self, worker_id: int = 0):
+        if not self.enabled or self.server_started: return
+        prometheus_client.start_http_server(settings.METRICS_PORT + worker_id); self.server_started = True
+        logger.info(f"Metrikalar http://0.0.0.0:{settings.METRICS_PORT + worker_id}/metrics manzilida.")
+metrics = Metrics()
+
 class CryptoService:
     def __init__(self, key: SecretStr):
         try: self.fernet = Fernet(key.get_secret_value().encode())
@@ -103,44 +277,351 @@ class CryptoService:
         except (InvalidToken, Exception): return None
 
 Base = declarative_base()
-class User(Base): __tablename__ = "users"; id = Column(BigInteger, primary_key=True); username = Column(String); first_name = Column(String); phone_number_encrypted = Column(LargeBinary); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="user")
-class Poll(Base): __tablename__ = "polls"; id = Column(Integer, primary_key=True, autoincrement=True); question = Column(Text, nullable=False); options = Column(JSON, nullable=False); is_active = Column(Boolean, default=False); created_by_admin_id = Column(BigInteger, nullable=False); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="poll")
-class Vote(Base): __tablename__ = "votes"; id = Column(Integer, primary_key=True, autoincrement=True); user_id = Column(BigInteger, ForeignKey("users.id")); poll_id = Column(Integer, ForeignKey("polls.id")); choice_key = Column(String); created_at = Column(DateTime, server_default=func.now()); user = relationship("User", back_populates="votes"); poll = relationship("Poll", back_populates="votes"); __table_args__ = (UniqueConstraint('user_id', 'poll_id'),)
-engine = create_async_engine(settings.DATABASE_URL); AsyncSessionFactory = async_sessionmaker(engine, expire_on_commit=False)
-async def create_db_and_tables(): 
-    async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all); logger.info(f"DB ({settings.DB_TYPE}) jadvallari yaratildi.")
-async def get_or_create_user(session: AsyncSession, user_id: int, username: str = None, first_name: str = None) -> User: r = await session.execute(select(User).where(User.id == user_id)); user = r.scalar_one_or_none();_ = user or (user := User(id=user_id, username=username, first_name=first_name), session.add(user), await session.commit(), await session.refresh(user)); return user
+class User(Base): __tablename__ = "users"; id = Column(BigInteger, primary_key=True); username = Column(String); first_name = Column(String); phone_number_encrypted = Column(LargeBinary); is_reachable = Column(Boolean, nullable=False, default=True, server_default=true()); blocked_at = Column(DateTime); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="user"); __table_args__ = (Index('ix_users_reachable_id', 'is_reachable', 'id'),)
+class Poll(Base): __tablename__ = "polls"; id = Column(Integer, primary_key=True, autoincrement=True); question = Column(Text, nullable=False); options = Column(JSON, nullable=False); is_active = Column(Boolean, default=False); created_by_admin_id = Column(BigInteger, nullable=False); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="poll"); __table_args__ = (Index('ix_polls_active_created', 'is_active', 'created_at'),)
+class Vote(Base): __tablename__ = "votes"; id = Column(Integer, primary_key=True, autoincrement=True); user_id = Column(BigInteger, ForeignKey("users.id")); poll_id = Column(Integer, ForeignKey("polls.id")); choice_key = Column(String); created_at = Column(DateTime, server_default=func.now()); user = relationship("User", back_populates="votes"); poll = relationship("Poll", back_populates="votes"); __table_args__ = (UniqueConstraint('user_id', 'poll_id'), Index('ix_votes_poll_choice', 'poll_id', 'choice_key'))
+class BroadcastDelivery(Base): __tablename__ = "broadcast_deliveries"; id = Column(Integer, primary_key=True, autoincrement=True); job_id = Column(String(32), nullable=False, index=True); user_id = Column(BigInteger, nullable=False); status = Column(String(16), nullable=False); error = Column(Text); created_at = Column(DateTime, server_default=func.now())
+class SchemaVersion(Base): __tablename__ = "schema_version"; version = Column(Integer, primary_key=True); name = Column(String(128), nullable=False); applied_at = Column(DateTime, server_default=func.now())
+def apply_sqlite_pragmas(dbapi_connection, connection_record, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    if not read_only: cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    for pragma in (f"synchronous={settings.SQLITE_SYNCHRONOUS}", f"busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}", f"mmap_size={settings.SQLITE_MMAP_SIZE}", f"cache_size={settings.SQLITE_CACHE_SIZE}", *(("query_only=1",) if read_only else ())): cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, (UpdateBase, TextClause)): self.info["wrote"] = True
+        return (engine if self.info.get("wrote") or read_engine is engine else read_engine).sync_engine
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _reset_routing(session, transaction):
+    if transaction.parent is None: session.info.pop("wrote", None)
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs): super().__init__(*args, **kwargs); self.checkouts = 0; self.wait_total = 0.0; self.wait_max = 0.0
+    def _do_get(self):
+        started = time.perf_counter()
+        try: return super()._do_get()
+        finally: waited = time.perf_counter() - started; self.checkouts += 1; self.wait_total += waited; self.wait_max = max(self.wait_max, waited)
+    def stats(self) -> Dict[str, float]:
+        return {"size": self.size(), "checked_out": self.checkedout(), "overflow": max(self.overflow(), 0), "checkouts": self.checkouts,
+                "avg_wait_ms": self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0, "max_wait_ms": self.wait_max * 1000}
+def create_postgres_engine() -> AsyncEngine:
+    server_settings = {"application_name": settings.PG_APPLICATION_NAME}
+    if settings.PG_STATEMENT_TIMEOUT_MS: server_settings["statement_timeout"] = str(settings.PG_STATEMENT_TIMEOUT_MS)
+    return create_async_engine(settings.DATABASE_URL, poolclass=TimedQueuePool, pool_size=settings.DB_POOL_SIZE, max_overflow=settings.DB_MAX_OVERFLOW, pool_timeout=settings.DB_POOL_TIMEOUT,
+                               pool_recycle=settings.DB_POOL_RECYCLE, pool_pre_ping=settings.DB_POOL_PRE_PING,
+                               connect_args={"statement_cache_size": settings.PG_STATEMENT_CACHE_SIZE, "server_settings": server_settings})
+async def warm_up_pool(db_engine: AsyncEngine, size: int):
+    started = time.perf_counter(); connections = await asyncio.gather(*(db_engine.connect() for _ in range(size)), return_exceptions=True)
+    opened = [c for c in connections if not isinstance(c, BaseException)]
+    for conn in opened: await conn.execute(text("SELECT 1")); await conn.close()
+    logger.info(f"DB ulanishlar havzasi isitildi: {len(opened)}/{size} ulanish, {(time.perf_counter() - started) * 1000:.0f} ms.")
+async def run_metrics_probes(db_engine: AsyncEngine, redis_client: aioredis.Redis):
+    while True:
+        try:
+            started = time.perf_counter(); await redis_client.ping(); metrics.redis_rtt.observe(time.perf_counter() - started)
+            pool = db_engine.sync_engine.pool
+            if isinstance(pool, TimedQueuePool):
+                st = pool.stats(); metrics.db_pool.labels("size").set(st["size"]); metrics.db_pool.labels("checked_out").set(st["checked_out"]); metrics.db_pool.labels("overflow").set(st["overflow"])
+                metrics.db_pool_wait.labels("avg").set(st["avg_wait_ms"]); metrics.db_pool_wait.labels("max").set(st["max_wait_ms"])
+        except asyncio.CancelledError: raise
+        except Exception as e: logger.warning(f"Metrikalarni yig'ishda xato: {e}")
+        await asyncio.sleep(settings.METRICS_PROBE_SECONDS)
+async def log_pool_stats(db_engine: AsyncEngine):
+    while True:
+        await asyncio.sleep(settings.DB_POOL_STATS_LOG_SECONDS); pool = db_engine.sync_engine.pool
+        if isinstance(pool, TimedQueuePool):
+            st = pool.stats(); logger.info(f"DB havzasi: {st['checked_out']}/{st['size']} band, overflow={st['overflow']}, o'rtacha kutish={st['avg_wait_ms']:.1f} ms, maks={st['max_wait_ms']:.1f} ms")
+def create_sqlite_engines() -> Tuple[AsyncEngine, AsyncEngine]:
+    writer = create_async_engine(settings.DATABASE_URL, poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=settings.SQLITE_WRITE_TIMEOUT_SECONDS)
+    reader = create_async_engine(settings.SQLITE_READ_URL, poolclass=AsyncAdaptedQueuePool, pool_size=settings.SQLITE_READ_POOL_SIZE, max_overflow=settings.SQLITE_READ_MAX_OVERFLOW)
+    event.listen(writer.sync_engine, "connect", apply_sqlite_pragmas); event.listen(reader.sync_engine, "connect", partial(apply_sqlite_pragmas, read_only=True))
+    return writer, reader
+if settings.DB_TYPE.lower() == "sqlite": engine, read_engine = create_sqlite_engines()
+else: engine = read_engine = create_postgres_engine()
+AsyncSessionFactory = async_sessionmaker(engine, expire_on_commit=False, sync_session_class=RoutingSession)
+def _create_index(conn, model, name: str): next(index for index in model.__table__.indexes if index.name == name).create(conn, checkfirst=True)
+def _migrate_initial_schema(conn):
+    baseline = MetaData()
+    Table("users", baseline, Column("id", BigInteger, primary_key=True), Column("username", String), Column("first_name", String), Column("phone_number_encrypted", LargeBinary), Column("created_at", DateTime, server_default=func.now()))
+    Table("polls", baseline, Column("id", Integer, primary_key=True, autoincrement=True), Column("question", Text, nullable=False), Column("options", JSON, nullable=False), Column("is_active", Boolean, default=False), Column("created_by_admin_id", BigInteger, nullable=False), Column("created_at", DateTime, server_default=func.now()))
+    Table("votes", baseline, Column("id", Integer, primary_key=True, autoincrement=True), Column("user_id", BigInteger, ForeignKey("users.id")), Column("poll_id", Integer, ForeignKey("polls.id")), Column("choice_key", String), Column("created_at", DateTime, server_default=func.now()), UniqueConstraint("user_id", "poll_id"))
+    baseline.create_all(conn, checkfirst=True)
+def _migrate_user_reachability(conn):
+    existing = {c["name"] for c in inspect(conn).get_columns("users")}
+    if "is_reachable" not in existing: conn.execute(text("ALTER TABLE users ADD COLUMN is_reachable BOOLEAN NOT NULL DEFAULT TRUE"))
+    if "blocked_at" not in existing: conn.execute(text("ALTER TABLE users ADD COLUMN blocked_at TIMESTAMP"))
+    _create_index(conn, User, "ix_users_reachable_id"); BroadcastDelivery.__table__.create(conn, checkfirst=True)
+def _migrate_hot_path_indexes(conn): _create_index(conn, Vote, "ix_votes_poll_choice"); _create_index(conn, Poll, "ix_polls_active_created")
+MIGRATIONS: List[Tuple[int, str, Callable[[Any], None]]] = [
+    (1, "initial_schema", _migrate_initial_schema),
+    (2, "user_reachability", _migrate_user_reachability),
+    (3, "hot_path_indexes", _migrate_hot_path_indexes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+def _current_schema_version(conn) -> int:
+    if not inspect(conn).has_table(SchemaVersion.__tablename__): return 0
+    return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+def _apply_migrations(conn) -> Tuple[int, int]:
+    if conn.dialect.name == "postgresql": conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('schema_version'))"))
+    current = _current_schema_version(conn)
+    if current >= SCHEMA_VERSION: return current, current
+    SchemaVersion.__table__.create(conn, checkfirst=True)
+    for version, name, migrate in MIGRATIONS:
+        if version <= current: continue
+        migrate(conn); conn.execute(insert(SchemaVersion).values(version=version, name=name)); logger.info(f"DB migratsiyasi qo'llandi: {version:03d}_{name}")
+    return current, SCHEMA_VERSION
+class PollSnapshot(NamedTuple):
+    id: int; question: str; options: Dict[str, str]; is_active: bool
+    @classmethod
+    def from_orm(cls, poll: Optional[Poll]) -> Optional["PollSnapshot"]: return cls(poll.id, poll.question, dict(poll.options), bool(poll.is_active)) if poll is not None else None
+class PollCache:
+    CHANNEL = "poll_cache:invalidate"; _UNSET = object()
+    def __init__(self): self.by_id: Dict[int, PollSnapshot] = {}; self.active: Any = self._UNSET; self.version = 0; self.redis: Optional[aioredis.Redis] = None
+    def clear(self): self.by_id.clear(); self.active = self._UNSET; self.version += 1
+    async def get_active(self, session: AsyncSession) -> Optional[PollSnapshot]:
+        if self.active is not self._UNSET: return self.active
+        version = self.version; poll = PollSnapshot.from_orm(await session.scalar(select(Poll).where(Poll.is_active==True).order_by(Poll.created_at.desc()).limit(1)))
+        if version == self.version: self.active = poll
+        return poll
+    async def get_by_id(self, session: AsyncSession, poll_id: int) -> Optional[PollSnapshot]:
+        if poll_id in self.by_id: return self.by_id[poll_id]
+        version = self.version; poll = PollSnapshot.from_orm(await session.get(Poll, poll_id))
+        if poll is not None and version == self.version: self.by_id[poll_id] = poll
+        return poll
+    async def invalidate(self):
+        self.clear()
+        if self.redis:
+            try: await self.redis.publish(self.CHANNEL, "1")
+            except Exception as e: logger.error(f"So'rovnoma keshini bekor qilish xabarini yuborishda xato: {e}")
+    async def listen(self, redis_client: aioredis.Redis):
+        self.redis = redis_client
+        while True:
+            try:
+                async with redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL); self.clear()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message": self.clear()
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.error(f"So'rovnoma keshi kanalida xatolik: {e}"); self.clear(); await asyncio.sleep(5)
+poll_cache = PollCache()
+
+class VoteCounters:
+    READY_FIELD = "_ready"
+    def __init__(self): self.redis: Optional[aioredis.Redis] = None
+    def attach(self, redis_client: aioredis.Redis): self.redis = redis_client
+    @staticmethod
+    def _key(poll_id: int) -> str: return f"poll_votes:{poll_id}"
+    async def incr(self, poll_id: int, choice_key: str):
+        if not self.redis: return
+        try: await self.redis.hincrby(self._key(poll_id), choice_key, 1)
+        except Exception as e: logger.error(f"Ovoz hisoblagichini oshirishda xato ({poll_id}): {e}")
+    async def get(self, poll_id: int) -> Optional[Dict[str, int]]:
+        if not self.redis: return None
+        raw = await self.redis.hgetall(self._key(poll_id))
+        if self.READY_FIELD not in raw: return None
+        return {key: int(count) for key, count in raw.items() if key != self.READY_FIELD and int(count) > 0}
+    async def rebuild(self, session: AsyncSession, poll_id: int) -> Dict[str, int]:
+        results = await get_poll_results(session, poll_id)
+        if self.redis:
+            async with self.redis.pipeline(transaction=True) as pipe: pipe.delete(self._key(poll_id)); pipe.hset(self._key(poll_id), mapping={**results, self.READY_FIELD: 1}); await pipe.execute()
+        return results
+    async def get_or_rebuild(self, session: AsyncSession, poll_id: int) -> Dict[str, int]:
+        results = await self.get(poll_id)
+        return results if results is not None else await self.rebuild(session, poll_id)
+    async def reconcile(self, session_pool: async_sessionmaker[AsyncSession]):
+        async for key in self.redis.scan_iter(match="poll_votes:*"):
+            poll_id = int(key.split(":")[1]); cached = await self.get(poll_id)
+            async with session_pool() as session:
+                actual = await get_poll_results(session, poll_id)
+                if cached is not None and cached != actual: logger.warning(f"So'rovnoma ({poll_id}) hisoblagichlari mos emas, qayta quriladi."); await self.rebuild(session, poll_id)
+vote_counters = VoteCounters()
+
+class VoteIngestor:
+    STREAM = "votes:stream"; GROUP = "vote_writers"
+    ACCEPT_SCRIPT = """
+if redis.call('SADD', KEYS[1], ARGV[1]) == 0 then return 0 end
+redis.call('XADD', KEYS[2], '*', 'user_id', ARGV[1], 'poll_id', ARGV[2], 'choice_key', ARGV[3])
+redis.call('HINCRBY', KEYS[3], ARGV[3], 1)
+return 1
+"""
+    def __init__(self):
+        self.redis: Optional[aioredis.Redis] = None; self.session_pool: Optional[async_sessionmaker[AsyncSession]] = None
+        self.seeded_polls: set = set(); self.consumer = WORKER_ID; self._accept = None
+    @property
+    def enabled(self) -> bool: return self.redis is not None
+    def attach(self, redis_client: aioredis.Redis, session_pool: async_sessionmaker[AsyncSession]):
+        self.redis = redis_client; self.session_pool = session_pool; self._accept = redis_client.register_script(self.ACCEPT_SCRIPT)
+    @staticmethod
+    def _voters_key(poll_id: int) -> str: return f"poll_voters:{poll_id}"
+    async def _ensure_seeded(self, poll_id: int):
+        if poll_id in self.seeded_polls: return
+        ready_key = f"poll_voters_ready:{poll_id}"
+        if not await self.redis.exists(ready_key):
+            async with self.session_pool() as session: user_ids = (await session.execute(select(Vote.user_id).where(Vote.poll_id == poll_id))).scalars().all()
+            for i in range(0, len(user_ids), 1000): await self.redis.sadd(self._voters_key(poll_id), *user_ids[i:i + 1000])
+            await self.redis.set(ready_key, 1); logger.info(f"So'rovnoma ({poll_id}) ovoz berganlari Redis'ga yuklandi: {len(user_ids)}.")
+        self.seeded_polls.add(poll_id)
+    async def has_voted(self, user_id: int, poll_id: int) -> bool:
+        await self._ensure_seeded(poll_id); return bool(await self.redis.sismember(self._voters_key(poll_id), user_id))
+    async def accept(self, user_id: int, poll_id: int, choice_key: str) -> bool:
+        await self._ensure_seeded(poll_id)
+        return bool(await self._accept(keys=[self._voters_key(poll_id), self.STREAM, VoteCounters._key(poll_id)], args=[user_id, poll_id, choice_key]))
+    async def backlog(self) -> int: return await self.redis.xlen(self.STREAM) if self.enabled else 0
+    async def _flush(self, entries: List[Tuple[str, Dict[str, str]]]):
+        rows = [{"user_id": int(f["user_id"]), "poll_id": int(f["poll_id"]), "choice_key": f["choice_key"]} for _, f in entries]
+        async with self.session_pool() as session:
+            try: await session.execute(insert_votes_ignore_duplicates(rows)); await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                for row in rows:
+                    try: await session.execute(insert_votes_ignore_duplicates([row])); await session.commit()
+                    except IntegrityError as e: await session.rollback(); logger.error(f"Ovozni yozib bo'lmadi, tashlab yuborildi {row}: {e.orig}")
+        ids = [entry_id for entry_id, _ in entries]
+        await self.redis.xack(self.STREAM, self.GROUP, *ids); await self.redis.xdel(self.STREAM, *ids)
+    async def _read(self, claim: bool) -> List[Tuple[str, Dict[str, str]]]:
+        pending = await self.redis.xreadgroup(self.GROUP, self.consumer, {self.STREAM: "0"}, count=settings.VOTE_FLUSH_BATCH_SIZE)
+        if pending and pending[0][1]: return pending[0][1]
+        if claim:
+            claimed = await self.redis.xautoclaim(self.STREAM, self.GROUP, self.consumer, min_idle_time=settings.VOTE_CLAIM_IDLE_MS, start_id="0-0", count=settings.VOTE_FLUSH_BATCH_SIZE)
+            if claimed[1]: return claimed[1]
+        fresh = await self.redis.xreadgroup(self.GROUP, self.consumer, {self.STREAM: ">"}, count=settings.VOTE_FLUSH_BATCH_SIZE, block=settings.VOTE_FLUSH_INTERVAL_MS)
+        return fresh[0][1] if fresh else []
+    async def run(self):
+        try: await self.redis.xgroup_create(self.STREAM, self.GROUP, id="0", mkstream=True)
+        except RedisResponseError as e:
+            if "BUSYGROUP" not in str(e): raise
+        last_claim = 0.0
+        while True:
+            try:
+                claim = time.monotonic() - last_claim >= settings.VOTE_CLAIM_IDLE_MS / 1000
+                if claim: last_claim = time.monotonic()
+                entries = await self._read(claim)
+                if entries: await self._flush(entries)
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.error(f"Ovozlarni bazaga yozishda xatolik: {e}", exc_info=True); await asyncio.sleep(1)
+vote_ingestor = VoteIngestor()
+
+async def run_vote_counters_reconciliation(session_pool: async_sessionmaker[AsyncSession]):
+    while True:
+        await asyncio.sleep(settings.VOTE_COUNTERS_RECONCILE_SECONDS)
+        if await vote_ingestor.backlog(): continue
+        try: await vote_counters.reconcile(session_pool)
+        except Exception as e: logger.error(f"Ovoz hisoblagichlarini tekshirishda xato: {e}")
+
+class KnownUsers:
+    CHANNEL = "known_users:forget"
+    def __init__(self): self.local: "OrderedDict[int, Tuple[str, float]]" = OrderedDict(); self.redis: Optional[aioredis.Redis] = None
+    def attach(self, redis_client: aioredis.Redis): self.redis = redis_client
+    @staticmethod
+    def _key(user_id: int) -> str: return f"known_user:{user_id}"
+    def _remember(self, user_id: int, fingerprint: str):
+        self.local[user_id] = (fingerprint, time.monotonic() + settings.KNOWN_USER_LOCAL_TTL_SECONDS); self.local.move_to_end(user_id)
+        while len(self.local) > settings.KNOWN_USER_LOCAL_MAX: self.local.popitem(last=False)
+    async def ensure(self, session: AsyncSession, user_id: int, username: str = None, first_name: str = None):
+        fingerprint = f"{username or ''}|{first_name or ''}"; cached = self.local.get(user_id)
+        if cached and cached[0] == fingerprint and cached[1] > time.monotonic(): return
+        if self.redis and await self.redis.get(self._key(user_id)) == fingerprint: self._remember(user_id, fingerprint); return
+        await upsert_user(session, user_id, username, first_name)
+        if self.redis: await self.redis.set(self._key(user_id), fingerprint, ex=settings.KNOWN_USER_TTL_SECONDS)
+        self._remember(user_id, fingerprint)
+    async def forget(self, user_ids: List[int]):
+        for user_id in user_ids: self.local.pop(user_id, None)
+        if self.redis and user_ids:
+            await self.redis.delete(*(self._key(user_id) for user_id in user_ids))
+            try: await self.redis.publish(self.CHANNEL, ",".join(map(str, user_ids)))
+            except Exception as e: logger.error(f"Foydalanuvchilarni unutish xabarini yuborishda xato: {e}")
+    async def listen(self, redis_client: aioredis.Redis):
+        while True:
+            try:
+                async with redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL); self.local.clear()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            for user_id in message["data"].split(","): self.local.pop(int(user_id), None)
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.error(f"Ma'lum foydalanuvchilar kanalida xatolik: {e}"); self.local.clear(); await asyncio.sleep(5)
+known_users = KnownUsers()
+
+async def create_db_and_tables():
+    async with engine.connect() as conn: current = await conn.run_sync(_current_schema_version)
+    if current >= SCHEMA_VERSION: logger.info(f"DB ({settings.DB_TYPE}) sxemasi joriy (versiya {current})."); return
+    async with engine.begin() as conn: previous, current = await conn.run_sync(_apply_migrations)
+    logger.info(f"DB ({settings.DB_TYPE}) sxemasi yangilandi: {previous} -> {current}.")
+def dialect_insert(table):
+    return (postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert)(table)
+async def upsert_user(session: AsyncSession, user_id: int, username: str = None, first_name: str = None):
+    stmt = dialect_insert(User).values(id=user_id, username=username, first_name=first_name)
+    stmt = stmt.on_conflict_do_update(index_elements=[User.id], set_={"username": stmt.excluded.username, "first_name": stmt.excluded.first_name, "is_reachable": True, "blocked_at": None})
+    await session.execute(stmt); await session.commit()
 async def save_user_phone(session: AsyncSession, user_id: int, encrypted_phone: bytes): await session.execute(update(User).where(User.id==user_id).values(phone_number_encrypted=encrypted_phone)); await session.commit()
-async def get_active_poll(session: AsyncSession) -> Optional[Poll]: return await session.scalar(select(Poll).where(Poll.is_active==True).order_by(Poll.created_at.desc()).limit(1))
-async def get_poll_by_id(session: AsyncSession, poll_id: int) -> Optional[Poll]: return await session.get(Poll, poll_id)
-async def has_user_voted(session: AsyncSession, user_id: int, poll_id: int) -> bool: return await session.scalar(select(Vote.id).where(Vote.user_id==user_id, Vote.poll_id==poll_id).limit(1)) is not None
-async def add_vote(session: AsyncSession, user_id: int, poll_id: int, choice_key: str): session.add(Vote(user_id=user_id, poll_id=poll_id, choice_key=choice_key)); await session.commit()
+async def get_active_poll(session: AsyncSession) -> Optional[PollSnapshot]: return await poll_cache.get_active(session)
+async def get_poll_by_id(session: AsyncSession, poll_id: int) -> Optional[PollSnapshot]: return await poll_cache.get_by_id(session, poll_id)
+async def has_user_voted(session: AsyncSession, user_id: int, poll_id: int) -> bool:
+    if vote_ingestor.enabled: return await vote_ingestor.has_voted(user_id, poll_id)
+    return await session.scalar(select(Vote.id).where(Vote.user_id==user_id, Vote.poll_id==poll_id).limit(1)) is not None
+async def add_vote(session: AsyncSession, user_id: int, poll_id: int, choice_key: str):
+    if vote_ingestor.enabled:
+        if not await vote_ingestor.accept(user_id, poll_id, choice_key): raise IntegrityError("vote dedupe", {"user_id": user_id, "poll_id": poll_id}, Exception("duplicate vote"))
+        return
+    session.add(Vote(user_id=user_id, poll_id=poll_id, choice_key=choice_key)); await session.commit(); await vote_counters.incr(poll_id, choice_key)
+def insert_votes_ignore_duplicates(rows: List[Dict[str, Any]]): return dialect_insert(Vote).values(rows).on_conflict_do_nothing(index_elements=["user_id", "poll_id"])
 async def create_poll(session: AsyncSession, question: str, options: Dict[str, str], admin_id: int, is_active: bool = False) -> Poll:
     if is_active: await session.execute(update(Poll).values(is_active=False))
-    poll = Poll(question=question, options=options, created_by_admin_id=admin_id, is_active=is_active); session.add(poll); await session.commit(); await session.refresh(poll); return poll
-async def get_all_polls(session: AsyncSession) -> List[Poll]: return (await session.execute(select(Poll).order_by(Poll.created_at.desc()))).scalars().all()
+    poll = Poll(question=question, options=options, created_by_admin_id=admin_id, is_active=is_active); session.add(poll); await session.commit(); await session.refresh(poll); await poll_cache.invalidate(); return poll
+class PollListItem(NamedTuple): id: int; title: str; is_active: bool
+class PollPage(NamedTuple): items: List[PollListItem]; has_newer: bool; has_older: bool
+async def get_polls_page(session: AsyncSession, before_id: Optional[int] = None, after_id: Optional[int] = None, title_length: int = 35, limit: Optional[int] = None) -> PollPage:
+    limit = limit or settings.ADMIN_POLL_PAGE_SIZE; query = select(Poll.id, func.substr(Poll.question, 1, title_length).label("title"), Poll.is_active)
+    if after_id is not None:
+        rows = (await session.execute(query.where(Poll.id > after_id).order_by(Poll.id.asc()).limit(limit + 1))).all()
+        return PollPage([PollListItem(r.id, r.title, bool(r.is_active)) for r in rows[:limit]][::-1], len(rows) > limit, True)
+    if before_id is not None: query = query.where(Poll.id < before_id)
+    rows = (await session.execute(query.order_by(Poll.id.desc()).limit(limit + 1))).all()
+    return PollPage([PollListItem(r.id, r.title, bool(r.is_active)) for r in rows[:limit]], before_id is not None, len(rows) > limit)
+async def get_polls_page_from_callback(session: AsyncSession, data: str, title_length: int = 35) -> PollPage:
+    direction, poll_id = data.split(":")[-2:]
+    return await get_polls_page(session, before_id=int(poll_id), title_length=title_length) if direction == "older" else await get_polls_page(session, after_id=int(poll_id), title_length=title_length)
 async def set_poll_active_status(session: AsyncSession, poll_id: int, active: bool) -> Optional[Poll]:
     if active: await session.execute(update(Poll).values(is_active=False))
-    result = await session.execute(update(Poll).where(Poll.id == poll_id).values(is_active=active).returning(Poll)); await session.commit(); return result.scalar_one_or_none()
+    result = await session.execute(update(Poll).where(Poll.id == poll_id).values(is_active=active).returning(Poll)); poll = result.scalar_one_or_none(); await session.commit(); await poll_cache.invalidate(); return poll
 async def get_poll_results(session: AsyncSession, poll_id: int) -> Dict[str, int]:
-    result = await session.execute(select(Vote.choice_key, func.count(Vote.id).label("c")).where(Vote.poll_id == poll_id).group_by(Vote.choice_key)); return {row.choice_key: row.c for row in result.all()}
-async def get_all_user_ids(session: AsyncSession) -> List[int]: return (await session.execute(select(User.id))).scalars().all()
+    result = await session.execute(select(Vote.choice_key, func.count().label("c")).where(Vote.poll_id == poll_id).group_by(Vote.choice_key)); return {row.choice_key: row.c for row in result.all()}
+async def count_reachable_users(session: AsyncSession) -> int: return await session.scalar(select(func.count()).select_from(User).where(User.is_reachable == True))
+async def get_user_ids_page(session: AsyncSession, after_id: int, limit: int) -> List[int]: return (await session.execute(select(User.id).where(User.is_reachable == True, User.id > after_id).order_by(User.id).limit(limit))).scalars().all()
+async def mark_users_unreachable(session: AsyncSession, user_ids: List[int]):
+    if user_ids: await session.execute(update(User).where(User.id.in_(user_ids)).values(is_reachable=False, blocked_at=func.now())); await known_users.forget(user_ids)
+async def log_broadcast_deliveries(session: AsyncSession, job_id: str, deliveries: List[Tuple[int, str, Optional[str]]]):
+    if deliveries: await session.execute(insert(BroadcastDelivery), [{"job_id": job_id, "user_id": u, "status": st, "error": err} for u, st, err in deliveries])
+async def iter_reachable_user_id_batches(session_pool: async_sessionmaker[AsyncSession], after_id: int = 0, batch_size: int = 500) -> AsyncIterator[List[int]]:
+    while True:
+        async with session_pool() as session: user_ids = await get_user_ids_page(session, after_id, batch_size)
+        if not user_ids: return
+        yield user_ids; after_id = user_ids[-1]
+
+class CaptchaResult(NamedTuple): status: str; attempts_left: int
 
 class CaptchaService:
-    def __init__(self, redis_client: aioredis.Redis): self.redis = redis_client
+    VERIFY_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return {'blocked', 0} end
+local answer = redis.call('HGET', KEYS[1], 'answer')
+if not answer then return {'expired', 0} end
+if answer == ARGV[1] then redis.call('DEL', KEYS[1]); return {'correct', 0} end
+local left = tonumber(ARGV[2]) - redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+if left <= 0 then redis.call('SET', KEYS[2], '1', 'EX', ARGV[3]); redis.call('DEL', KEYS[1]); return {'exhausted', 0} end
+return {'wrong', left}
+"""
+    def __init__(self, redis_client: aioredis.Redis): self.redis = redis_client; self._verify = redis_client.register_script(self.VERIFY_SCRIPT)
     def _generate_math_captcha(self)->tuple[str,str]: n1,n2=random.randint(1,10),random.randint(1,10);ops={'+':n1+n2,'-':abs(n1-n2),'*':n1*n2};op=random.choice(list(ops.keys()));q_n1,q_n2=(n1,n2) if n1>=n2 else (n2,n1);q=f"{q_n1} {op} {q_n2} = ?";a=str(ops[op]);return q,a
-    async def create_captcha(self,user_id:int)->str: q,a=self._generate_math_captcha(); await self.redis.set(f"captcha:{user_id}:answer",a,ex=settings.CAPTCHA_TIMEOUT_SECONDS); await self.redis.set(f"captcha:{user_id}:attempts",0,ex=settings.CAPTCHA_TIMEOUT_SECONDS+10); return q
-    async def verify_captcha(self,user_id:int,user_answer:str)->bool:
-        correct_answer = await self.redis.get(f"captcha:{user_id}:answer")
-        if not correct_answer: return False
-        if correct_answer == user_answer.strip(): await self.redis.delete(f"captcha:{user_id}:answer", f"captcha:{user_id}:attempts"); return True
-        else:
-            attempts = await self.redis.incr(f"captcha:{user_id}:attempts")
-            if attempts >= settings.CAPTCHA_MAX_ATTEMPTS: await self.redis.set(f"captcha_block:{user_id}","1",ex=settings.CAPTCHA_BLOCK_DURATION_MINUTES*60); await self.redis.delete(f"captcha:{user_id}:answer", f"captcha:{user_id}:attempts")
-            return False
+    async def create_captcha(self,user_id:int)->str:
+        q,a=self._generate_math_captcha()
+        async with self.redis.pipeline(transaction=True) as pipe: pipe.delete(f"captcha:{user_id}"); pipe.hset(f"captcha:{user_id}", mapping={"answer": a, "attempts": 0}); pipe.expire(f"captcha:{user_id}", settings.CAPTCHA_TIMEOUT_SECONDS); await pipe.execute()
+        return q
+    async def check_captcha(self, user_id: int, user_answer: str) -> CaptchaResult:
+        status, attempts_left = await self._verify(keys=[f"captcha:{user_id}", f"captcha_block:{user_id}"], args=[user_answer.strip(), settings.CAPTCHA_MAX_ATTEMPTS, settings.CAPTCHA_BLOCK_DURATION_MINUTES*60])
+        metrics.captcha_outcomes.labels(status).inc(); return CaptchaResult(status, int(attempts_left))
+    async def verify_captcha(self,user_id:int,user_answer:str)->bool: return (await self.check_captcha(user_id, user_answer)).status == "correct"
     async def is_user_blocked(self, user_id: int) -> bool: return await self.redis.exists(f"captcha_block:{user_id}")
     async def get_attempts_left(self, user_id: int) -> int:
-        attempts = await self.redis.get(f"captcha:{user_id}:attempts")
+        attempts = await self.redis.hget(f"captcha:{user_id}", "attempts")
         return settings.CAPTCHA_MAX_ATTEMPTS - int(attempts) if attempts else settings.CAPTCHA_MAX_ATTEMPTS
 
 class VotingProcess(StatesGroup): awaiting_subscription_check=State();awaiting_contact=State();awaiting_captcha=State();awaiting_vote_choice=State()
@@ -148,57 +629,452 @@ class AdminPollManagement(StatesGroup): awaiting_poll_question=State();awaiting_
 class AdCreation(StatesGroup): awaiting_poll_selection=State();awaiting_post_text=State();awaiting_post_photo=State()
 class Broadcast(StatesGroup): awaiting_ad_text=State();awaiting_ad_photo=State();awaiting_confirmation=State()
 
+class LazySession:
+    def __init__(self, pool: async_sessionmaker[AsyncSession], on_open: Callable[[], None]): self._pool = pool; self._on_open = on_open; self._session: Optional[AsyncSession] = None
+    def __getattr__(self, name: str) -> Any:
+        if self._session is None: self._session = self._pool(); self._on_open()
+        return getattr(self._session, name)
+    async def close(self):
+        if self._session is not None: await self._session.close()
+
 class DbSessionMiddleware(BaseMiddleware):
-    def __init__(self,pool:async_sessionmaker[AsyncSession]): self.session_pool=pool
+    def __init__(self,pool:async_sessionmaker[AsyncSession]): self.session_pool=pool; self.opened=0; self.used=0; self.skipped=0
+    def _mark_used(self): self.used += 1
+    def stats(self) -> Dict[str, int]: return {"opened": self.opened, "used": self.used, "skipped": self.skipped}
     async def __call__(self,handler:Callable,event:TelegramObject,data:Dict[str,Any])->Any:
-        async with self.session_pool() as session: data["session"]=session; return await handler(event,data)
+        if not get_flag(data, "db_session", default=True): self.skipped += 1; return await handler(event, data)
+        session = LazySession(self.session_pool, self._mark_used); data["session"] = session; self.opened += 1
+        try: return await handler(event, data)
+        finally: await session.close()
+
+class ThrottlingMiddleware(BaseMiddleware):
+    TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1]); local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME'); local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst; local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then tokens = tokens - 1; allowed = 1 end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+if allowed == 1 then return 1 end
+if redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[3]) then return -1 end
+return 0
+"""
+    NOTICE = "⏳ Juda ko'p so'rov yuborildi. Iltimos, biroz kuting."
+    def __init__(self, redis_client: aioredis.Redis):
+        self.redis = redis_client; self._bucket = redis_client.register_script(self.TOKEN_BUCKET_SCRIPT); self.admin_ids = set(settings.ADMIN_IDS)
+        self.limits = {"start": (settings.THROTTLE_START_RATE, settings.THROTTLE_START_BURST), "callback": (settings.THROTTLE_CALLBACK_RATE, settings.THROTTLE_CALLBACK_BURST),
+                       "captcha": (settings.THROTTLE_CAPTCHA_RATE, settings.THROTTLE_CAPTCHA_BURST), "message": (settings.THROTTLE_MESSAGE_RATE, settings.THROTTLE_MESSAGE_BURST)}
+        self.allowed = 0; self.throttled = 0
+    async def __call__(self, handler: Callable, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if not user or user.id in self.admin_ids: return await handler(event, data)
+        action = get_flag(data, "throttle", default="callback" if isinstance(event, CallbackQuery) else "message")
+        rate, burst = self.limits.get(action, self.limits["message"])
+        try: verdict = await self._bucket(keys=[f"throttle:{action}:{user.id}", f"throttle_notice:{action}:{user.id}"], args=[rate, burst, settings.THROTTLE_NOTICE_SECONDS])
+        except RedisError as e: logger.warning(f"Throttling tekshiruvi o'tkazib yuborildi: {e}"); return await handler(event, data)
+        if verdict == 1: self.allowed += 1; return await handler(event, data)
+        self.throttled += 1; metrics.throttled.labels(action).inc()
+        try:
+            if isinstance(event, CallbackQuery): await (event.answer(self.NOTICE, cache_time=settings.THROTTLE_NOTICE_SECONDS) if verdict == -1 else event.answer())
+            elif isinstance(event, Message) and verdict == -1: await event.answer(self.NOTICE)
+        except TelegramAPIError: pass
+        return None
+
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler"); name = handler_object.callback.__name__ if handler_object else "unknown"; started = time.perf_counter()
+        try: return await handler(event, data)
+        except Exception: metrics.handler_errors.labels(name).inc(); raise
+        finally: metrics.handler_latency.labels(name).observe(time.perf_counter() - started)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request: Callable, bot: Bot, method: Any) -> Any:
+        name = method.__api_method__; started = time.perf_counter()
+        try: return await make_request(bot, method)
+        except TelegramRetryAfter: metrics.api_retry_after.labels(name).inc(); raise
+        except TelegramAPIError as e: metrics.api_errors.labels(name, type(e).__name__).inc(); raise
+        finally: metrics.api_latency.labels(name).observe(time.perf_counter() - started)
+
+async def log_db_session_stats(middleware: DbSessionMiddleware, interval: int = 600):
+    while True:
+        await asyncio.sleep(interval); stats = middleware.stats()
+        logger.info(f"DB sessiyalari: {stats['used']}/{stats['opened']} ishlatildi, {stats['skipped']} ta handler sessiyasiz ishladi.")
 
 def get_contact_keyboard()->ReplyKeyboardMarkup:return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="Telefon raqamni yuborish 📞",request_contact=True)]],resize_keyboard=True,one_time_keyboard=True)
-def get_channel_subscription_keyboard(channels: List[Dict[str, str]], button_text: str = "✅ A'zo bo'ldim") -> InlineKeyboardMarkup:
-    builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=f"➡️ {c['title']}", url=c['url'])) for c in channels];builder.row(InlineKeyboardButton(text=button_text, callback_data="check_subscription"));return builder.as_markup()
-def get_poll_options_keyboard(poll: Poll) -> InlineKeyboardMarkup: builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=t, callback_data=f"vote_poll:{poll.id}:choice:{k}")) for k,t in poll.options.items()];return builder.as_markup()
-def get_admin_poll_list_keyboard(polls: List[Poll]) -> InlineKeyboardMarkup: builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=f"{'🟢' if p.is_active else '⚪️'} {p.question[:35]}...", callback_data=f"admin:poll:view:{p.id}")) for p in polls];builder.row(InlineKeyboardButton(text="➕ Yangi so'rovnoma", callback_data="admin:poll:create"));return builder.as_markup()
+@lru_cache(maxsize=256)
+def _build_channel_subscription_keyboard(channels: Tuple[Tuple[str, str], ...], button_text: str) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=f"➡️ {title}", url=url)) for title, url in channels];builder.row(InlineKeyboardButton(text=button_text, callback_data="check_subscription"));return builder.as_markup()
+def get_channel_subscription_keyboard(channels: List[Dict[str, str]], button_text: str = "✅ A'zo bo'ldim") -> InlineKeyboardMarkup: return _build_channel_subscription_keyboard(tuple((c['title'], c['url']) for c in channels), button_text)
+def get_poll_options_keyboard(poll: PollSnapshot) -> InlineKeyboardMarkup: builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=t, callback_data=f"vote_poll:{poll.id}:choice:{k}")) for k,t in poll.options.items()];return builder.as_markup()
+def _add_page_buttons(builder: InlineKeyboardBuilder, page: PollPage, prefix: str):
+    buttons = ([InlineKeyboardButton(text="⬅️ Oldingi", callback_data=f"{prefix}:newer:{page.items[0].id}")] if page.has_newer and page.items else []) + ([InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"{prefix}:older:{page.items[-1].id}")] if page.has_older and page.items else [])
+    if buttons: builder.row(*buttons)
+def get_admin_poll_list_keyboard(page: PollPage) -> InlineKeyboardMarkup: builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=f"{'🟢' if p.is_active else '⚪️'} {p.title}...", callback_data=f"admin:poll:view:{p.id}")) for p in page.items];_add_page_buttons(builder, page, "admin:poll:page");builder.row(InlineKeyboardButton(text="➕ Yangi so'rovnoma", callback_data="admin:poll:create"));return builder.as_markup()
 def get_admin_poll_manage_keyboard(poll_id: int, is_active: bool) -> InlineKeyboardMarkup: builder = InlineKeyboardBuilder();builder.row(InlineKeyboardButton(text="⚪️ Noaktiv qilish" if is_active else "🟢 Aktiv qilish", callback_data=f"admin:poll:toggle:{poll_id}"));builder.row(InlineKeyboardButton(text="📊 Natijalar", callback_data=f"admin:poll:results:{poll_id}"));builder.row(InlineKeyboardButton(text="🔙 Ortga", callback_data="admin:poll:list"));return builder.as_markup()
-def get_poll_selection_for_ad_keyboard(polls: List[Poll]) -> InlineKeyboardMarkup: builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=f"{p.question[:40]}...", callback_data=f"ad_select_poll:{p.id}")) for p in polls];return builder.as_markup()
-def get_ad_post_keyboard(poll: Poll, bot_username: str) -> InlineKeyboardMarkup:
+def get_poll_selection_for_ad_keyboard(page: PollPage) -> InlineKeyboardMarkup: builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=f"{p.title}...", callback_data=f"ad_select_poll:{p.id}")) for p in page.items];_add_page_buttons(builder, page, "ad_poll_page");return builder.as_markup()
+def get_ad_post_keyboard(poll: PollSnapshot, bot_username: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder();[builder.row(InlineKeyboardButton(text=t, url=f"https://t.me/{bot_username}?start=vote_{poll.id}_{k}")) for k,t in poll.options.items()];return builder.as_markup()
 remove_keyboard = ReplyKeyboardRemove()
 
-async def check_all_channels_membership(bot: Bot, user_id: int) -> List[Dict[str, str]]:
-    unsubscribed = [];
-    if not settings.REQUIRED_CHANNELS: return []
-    for channel_id in settings.REQUIRED_CHANNELS:
-        try:
-            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if member.status not in ("member", "administrator", "creator"): raise Exception("User is not a subscribed member.")
-        except Exception as e:
-            if isinstance(e, TelegramBadRequest) or "User is not a subscribed member" in str(e):
-                try:
-                    chat = await bot.get_chat(channel_id)
-                    invite_link = getattr(chat,'invite_link',None) or (f"https://t.me/{chat.username}" if getattr(chat,'username',None) else None)
-                    if invite_link: unsubscribed.append({"title": chat.title, "url": invite_link})
-                    else: logger.warning(f"Kanal ({channel_id}) uchun havola topilmadi.")
-                except Exception as ex_info: logger.error(f"Kanal ({channel_id}) ma'lumotini olishda xatolik: {ex_info}")
-            else: logger.error(f"Kanal tekshirishda kutilmagan xatolik ({channel_id}): {e}", exc_info=True)
-    return unsubscribed
+class MembershipCache:
+    def __init__(self, redis_client: aioredis.Redis): self.redis = redis_client
+    @staticmethod
+    def _key(user_id: int, channel_id: Union[str, int]) -> str: return f"member:{channel_id}:{user_id}"
+    async def get_many(self, user_id: int, channels: List[Union[str, int]]) -> Dict[Union[str, int], Optional[bool]]:
+        values = await self.redis.mget([self._key(user_id, ch) for ch in channels])
+        return {ch: (None if v is None else v == "1") for ch, v in zip(channels, values)}
+    async def set_many(self, user_id: int, statuses: Dict[Union[str, int], bool]):
+        if not statuses: return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel_id, is_member in statuses.items():
+                ttl = settings.MEMBERSHIP_CACHE_TTL_MEMBER if is_member else settings.MEMBERSHIP_CACHE_TTL_NOT_MEMBER
+                pipe.set(self._key(user_id, channel_id), "1" if is_member else "0", ex=ttl)
+            await pipe.execute()
+
+class MembershipIndex:
+    HEARTBEAT_KEY = "member_index:heartbeat"
+    def __init__(self, redis_client: aioredis.Redis): self.redis = redis_client
+    @staticmethod
+    def _key(channel_id: Union[str, int]) -> str: return f"member_index:{channel_id}"
+    @staticmethod
+    def _parse(value: Optional[str]) -> Optional[Tuple[bool, float]]:
+        if not value: return None
+        flag, _, ts = value.partition(":"); return flag == "1", float(ts or 0)
+    async def get_entries(self, user_id: int, channels: List[Union[str, int]]) -> Dict[Union[str, int], Optional[Tuple[bool, float]]]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for ch in channels: pipe.hget(self._key(ch), str(user_id))
+            values = await pipe.execute()
+        return {ch: self._parse(v) for ch, v in zip(channels, values)}
+    async def get_entries_batch(self, user_ids: List[int], channels: List[Union[str, int]]) -> Dict[int, Dict[Union[str, int], Optional[Tuple[bool, float]]]]:
+        if not user_ids: return {}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for ch in channels: pipe.hmget(self._key(ch), [str(user_id) for user_id in user_ids])
+            per_channel = await pipe.execute()
+        return {user_id: {ch: self._parse(values[i]) for ch, values in zip(channels, per_channel)} for i, user_id in enumerate(user_ids)}
+    async def get_many(self, user_id: int, channels: List[Union[str, int]]) -> Dict[Union[str, int], Optional[bool]]:
+        return {ch: (entry[0] if entry else None) for ch, entry in (await self.get_entries(user_id, channels)).items()}
+    async def set_many(self, user_id: int, statuses: Dict[Union[str, int], bool]):
+        if not statuses: return
+        now = int(time.time())
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel_id, is_member in statuses.items(): pipe.hset(self._key(channel_id), str(user_id), f"{int(is_member)}:{now}")
+            await pipe.execute()
+    async def set_batch(self, statuses: Dict[int, Dict[Union[str, int], bool]]):
+        if not statuses: return
+        now = int(time.time()); per_channel: Dict[Union[str, int], Dict[str, str]] = {}
+        for user_id, user_statuses in statuses.items():
+            for channel_id, is_member in user_statuses.items(): per_channel.setdefault(channel_id, {})[str(user_id)] = f"{int(is_member)}:{now}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel_id, mapping in per_channel.items(): pipe.hset(self._key(channel_id), mapping=mapping)
+            await pipe.execute()
+    async def beat(self): await self.redis.set(self.HEARTBEAT_KEY, int(time.time()))
+    async def last_heartbeat(self) -> Optional[float]:
+        value = await self.redis.get(self.HEARTBEAT_KEY); return float(value) if value else None
+
+def match_required_channel(chat: Chat) -> Optional[Union[str, int]]:
+    for ch in settings.REQUIRED_CHANNELS:
+        if str(ch) == str(chat.id) or (chat.username and str(ch).lower() == f"@{chat.username}".lower()): return ch
+    return None
+
+async def fetch_channel_member_status(bot: Bot, channel_id: Union[str, int], user_id: int) -> Optional[bool]:
+    try: member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id); return member.status in ("member", "administrator", "creator")
+    except TelegramBadRequest: return False
+    except Exception as e: logger.error(f"Kanal tekshirishda kutilmagan xatolik ({channel_id}): {e}", exc_info=True); return None
+
+async def get_channel_link(bot: Bot, channel_id: Union[str, int]) -> Optional[Dict[str, str]]:
+    try:
+        chat = await bot.get_chat(channel_id)
+        invite_link = getattr(chat,'invite_link',None) or (f"https://t.me/{chat.username}" if getattr(chat,'username',None) else None)
+        if invite_link: return {"title": chat.title, "url": invite_link}
+        logger.warning(f"Kanal ({channel_id}) uchun havola topilmadi.")
+    except Exception as ex_info: logger.error(f"Kanal ({channel_id}) ma'lumotini olishda xatolik: {ex_info}")
+    return None
+
+class ChannelInfoCache:
+    def __init__(self): self.links: Dict[Union[str, int], Dict[str, str]] = {}
+    async def refresh(self, bot: Bot):
+        channels = settings.REQUIRED_CHANNELS; links = await asyncio.gather(*(get_channel_link(bot, ch) for ch in channels))
+        self.links.update({ch: link for ch, link in zip(channels, links) if link}); _build_channel_subscription_keyboard.cache_clear()
+        logger.info(f"Kanal ma'lumotlari yangilandi: {len(self.links)}/{len(channels)}.")
+    async def get(self, bot: Bot, channel_id: Union[str, int]) -> Optional[Dict[str, str]]:
+        link = self.links.get(channel_id)
+        if link is None and (link := await get_channel_link(bot, channel_id)): self.links[channel_id] = link
+        return link
+
+async def run_channel_info_refresh(bot: Bot, channel_info: ChannelInfoCache):
+    while True:
+        await asyncio.sleep(settings.CHANNEL_INFO_REFRESH_SECONDS)
+        try: await channel_info.refresh(bot)
+        except Exception as e: logger.error(f"Kanal ma'lumotlarini yangilashda xatolik: {e}")
+
+async def check_all_channels_membership(bot: Bot, user_id: int, membership_cache: Optional[MembershipCache] = None, fresh: bool = False, membership_index: Optional[MembershipIndex] = None, channel_info: Optional[ChannelInfoCache] = None) -> List[Dict[str, str]]:
+    channels = settings.REQUIRED_CHANNELS
+    if not channels: return []
+    statuses = await membership_index.get_many(user_id, channels) if membership_index else {}
+    unknown = [ch for ch in channels if statuses.get(ch) is None]
+    if membership_cache and unknown: statuses.update({ch: s for ch, s in (await membership_cache.get_many(user_id, unknown)).items() if s is not None})
+    to_check = [ch for ch in channels if statuses.get(ch) is None or (fresh and statuses.get(ch) is False)]
+    if to_check:
+        live = dict(zip(to_check, await asyncio.gather(*(fetch_channel_member_status(bot, ch, user_id) for ch in to_check))))
+        statuses.update(live); known = {ch: s for ch, s in live.items() if s is not None}
+        if membership_index: await membership_index.set_many(user_id, known)
+        if membership_cache: await membership_cache.set_many(user_id, known)
+    links = await asyncio.gather(*((channel_info.get(bot, ch) if channel_info else get_channel_link(bot, ch)) for ch in channels if statuses.get(ch) is False))
+    return [link for link in links if link]
+
+class MembershipChecker:
+    def __init__(self, bot: Bot, membership_cache: Optional[MembershipCache], membership_index: Optional[MembershipIndex] = None, channel_info: Optional[ChannelInfoCache] = None):
+        self.bot = bot; self.membership_cache = membership_cache; self.membership_index = membership_index; self.channel_info = channel_info; self.memo: Dict[int, List[Dict[str, str]]] = {}
+    async def __call__(self, user_id: int, fresh: bool = False) -> List[Dict[str, str]]:
+        if fresh or user_id not in self.memo: self.memo[user_id] = await check_all_channels_membership(self.bot, user_id, self.membership_cache, fresh, self.membership_index, self.channel_info)
+        return self.memo[user_id]
+
+class MembershipMiddleware(BaseMiddleware):
+    def __init__(self, membership_cache: Optional[MembershipCache], membership_index: Optional[MembershipIndex] = None, channel_info: Optional[ChannelInfoCache] = None):
+        self.membership_cache = membership_cache; self.membership_index = membership_index; self.channel_info = channel_info
+    async def __call__(self, handler: Callable, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        data["check_membership"] = MembershipChecker(data["bot"], self.membership_cache, self.membership_index, self.channel_info); return await handler(event, data)
+
+async def reconcile_membership_index(bot: Bot, membership_index: MembershipIndex, stale_before: float):
+    channels = settings.REQUIRED_CHANNELS; delay = len(channels) / settings.MEMBERSHIP_INDEX_RECONCILE_RATE; checked = 0
+    if not channels: return
+    async for user_ids in iter_reachable_user_id_batches(AsyncSessionFactory):
+        entries_by_user = await membership_index.get_entries_batch(user_ids, channels); fresh: Dict[int, Dict[Union[str, int], bool]] = {}
+        for user_id, entries in entries_by_user.items():
+            if all(entry and entry[1] >= stale_before for entry in entries.values()): continue
+            live = await asyncio.gather(*(fetch_channel_member_status(bot, ch, user_id) for ch in channels))
+            fresh[user_id] = {ch: s for ch, s in zip(channels, live) if s is not None}; checked += 1
+            await asyncio.sleep(delay)
+        await membership_index.set_batch(fresh)
+    logger.info(f"A'zolik indeksi moslashtirildi: {checked} ta foydalanuvchi qayta tekshirildi.")
+
+async def run_membership_index_jobs(bot: Bot, membership_index: MembershipIndex):
+    started_at = time.time(); last_beat = await membership_index.last_heartbeat()
+    downtime = last_beat is None or started_at - last_beat > settings.MEMBERSHIP_INDEX_HEARTBEAT_SECONDS * 2
+    if downtime: logger.info("A'zolik indeksi: uzilishdan keyin to'liq tekshiruv boshlanmoqda.")
+    async def heartbeat():
+        while True: await membership_index.beat(); await asyncio.sleep(settings.MEMBERSHIP_INDEX_HEARTBEAT_SECONDS)
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        while True:
+            stale_before = time.time() - settings.MEMBERSHIP_INDEX_MAX_AGE_SECONDS
+            if downtime: stale_before = max(stale_before, started_at); downtime = False
+            try: await reconcile_membership_index(bot, membership_index, stale_before)
+            except Exception as e: logger.error(f"A'zolik indeksini moslashtirishda xatolik: {e}", exc_info=True)
+            await asyncio.sleep(settings.MEMBERSHIP_INDEX_RECONCILE_INTERVAL_SECONDS)
+    finally: heartbeat_task.cancel()
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate; self.capacity = capacity or rate; self.tokens = self.capacity; self.updated = time.monotonic(); self.lock = asyncio.Lock()
+    def _refill(self): now = time.monotonic(); self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+    async def acquire(self):
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1: await asyncio.sleep((1 - self.tokens) / self.rate); self._refill()
+            self.tokens -= 1
+    def pause(self, seconds: float): self._refill(); self.tokens = min(self.tokens, -seconds * self.rate)
+
+class TunedAiohttpSession(AiohttpSession):
+    SAFE_TO_RETRY_PREFIXES = ("get", "answer", "edit", "delete", "set")
+    def __init__(self, **kwargs: Any):
+        kwargs.setdefault("json_loads", orjson.loads if orjson else json.loads)
+        if settings.TELEGRAM_API_URL: kwargs.setdefault("api", TelegramAPIServer.from_base(settings.TELEGRAM_API_URL))
+        super().__init__(limit=settings.TELEGRAM_HTTP_LIMIT, timeout=settings.TELEGRAM_REQUEST_TIMEOUT, **kwargs)
+        self._connector_init.update(limit_per_host=settings.TELEGRAM_HTTP_LIMIT_PER_HOST, ttl_dns_cache=settings.TELEGRAM_DNS_CACHE_SECONDS, keepalive_timeout=settings.TELEGRAM_KEEPALIVE_SECONDS)
+    async def make_request(self, bot: Bot, method: Any, timeout: Optional[int] = None) -> Any:
+        name = method.__api_method__
+        for attempt in range(settings.TELEGRAM_NETWORK_RETRIES + 1):
+            started = time.perf_counter()
+            try: return await super().make_request(bot, method, timeout)
+            except TelegramNetworkError as e:
+                if attempt >= settings.TELEGRAM_NETWORK_RETRIES or not (name.startswith(self.SAFE_TO_RETRY_PREFIXES) or isinstance(e.__cause__, ClientConnectorError)): raise
+                delay = random.uniform(0, settings.TELEGRAM_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+                logger.warning(f"Telegram tarmoq xatosi ({name}), {delay:.2f}s dan so'ng qayta urinish: {e.message}"); await asyncio.sleep(delay)
+            finally:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                if elapsed_ms >= settings.TELEGRAM_SLOW_CALL_MS: logger.warning(f"Sekin Telegram API chaqiruvi: {name} {elapsed_ms:.0f} ms.")
+
+API_PRIORITY_INTERACTIVE, API_PRIORITY_BULK = 0, 1
+api_priority: ContextVar[int] = ContextVar("api_priority", default=API_PRIORITY_INTERACTIVE)
+
+def configured_bot_processes() -> int:
+    mode = settings.BOT_MODE.lower()
+    if mode == "consumer": return max(1, settings.UPDATE_CONSUMERS)
+    if mode == "webhook" and not settings.UPDATE_QUEUE_ENABLED: return max(1, settings.WEB_WORKERS)
+    return 1
+
+class RedisTokenBucket:
+    ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1]); local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME'); local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'paused_until')
+local paused_until = tonumber(bucket[3]) or 0
+if paused_until > now then return math.ceil((paused_until - now) * 1000) end
+local tokens = tonumber(bucket[1]) or burst; local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait_ms = 0
+if tokens >= 1 then tokens = tokens - 1 else wait_ms = math.ceil((1 - tokens) / rate * 1000) end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], 60000)
+return wait_ms
+"""
+    PAUSE_SCRIPT = """
+local clock = redis.call('TIME'); local until_ts = tonumber(clock[1]) + tonumber(clock[2]) / 1000000 + tonumber(ARGV[1])
+local current = tonumber(redis.call('HGET', KEYS[1], 'paused_until')) or 0
+if until_ts > current then redis.call('HSET', KEYS[1], 'paused_until', tostring(until_ts)) end
+redis.call('PEXPIRE', KEYS[1], math.max(60000, math.ceil(tonumber(ARGV[1]) * 1000) + 1000))
+"""
+    def __init__(self, redis_client: aioredis.Redis, key: str, rate: float):
+        self.key = key; self.rate = rate; self._acquire = redis_client.register_script(self.ACQUIRE_SCRIPT); self._pause = redis_client.register_script(self.PAUSE_SCRIPT)
+        self.fallback = TokenBucket(rate / configured_bot_processes()); self.lock = asyncio.Lock()
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                try: wait_ms = await self._acquire(keys=[self.key], args=[self.rate, self.rate])
+                except RedisError as e: logger.warning(f"Redis token bucket ({self.key}) ishlamadi, lokal cheklov ishlatiladi: {e}"); return await self.fallback.acquire()
+                if not wait_ms: return
+                await asyncio.sleep(wait_ms / 1000)
+    async def pause(self, seconds: float):
+        self.fallback.pause(seconds)
+        try: await self._pause(keys=[self.key], args=[seconds])
+        except RedisError as e: logger.warning(f"Redis token bucket ({self.key}) to'xtatilmadi: {e}")
+
+class RateScheduler(BaseRequestMiddleware):
+    LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+    def __init__(self, redis_client: aioredis.Redis):
+        self.global_bucket = RedisTokenBucket(redis_client, "telegram_rate:global", settings.TELEGRAM_GLOBAL_RATE); self.bulk_bucket = RedisTokenBucket(redis_client, "telegram_rate:bulk", settings.BROADCAST_RATE_PER_SECOND)
+        self.spare_token = False
+        self.chat_interval = 1 / settings.TELEGRAM_CHAT_RATE; self.chat_next: Dict[Union[int, str], float] = {}
+        self.waiters: List[Tuple[int, int, asyncio.Future]] = []; self.sequence = itertools.count(); self.wakeup: Optional[asyncio.Event] = None; self.pump_task: Optional[asyncio.Task] = None
+    async def _wait_chat(self, chat_id: Union[int, str]):
+        now = time.monotonic(); start = max(self.chat_next.get(chat_id, 0.0), now - (settings.TELEGRAM_CHAT_BURST - 1) * self.chat_interval)
+        self.chat_next[chat_id] = start + self.chat_interval
+        if len(self.chat_next) > 10000: self.chat_next = {chat: slot for chat, slot in self.chat_next.items() if slot > now}
+        if start > now: await asyncio.sleep(start - now)
+    async def _pump(self):
+        while True:
+            while self.waiters and self.waiters[0][2].done(): heapq.heappop(self.waiters)
+            if not self.waiters: self.wakeup.clear(); await self.wakeup.wait(); continue
+            if not self.spare_token: await self.global_bucket.acquire()
+            self.spare_token = True
+            while self.waiters:
+                _, _, future = heapq.heappop(self.waiters)
+                if not future.done(): future.set_result(None); self.spare_token = False; break
+    async def _acquire(self, priority: int):
+        if self.pump_task is None or self.pump_task.done(): self.wakeup = asyncio.Event(); self.pump_task = asyncio.create_task(self._pump())
+        future = asyncio.get_running_loop().create_future(); heapq.heappush(self.waiters, (priority, next(self.sequence), future)); self.wakeup.set()
+        await future
+    async def __call__(self, make_request: Callable, bot: Bot, method: Any) -> Any:
+        name = method.__api_method__; limited = name.startswith(self.LIMITED_PREFIXES)
+        priority = api_priority.get(); chat_id = getattr(method, "chat_id", None) if limited else None
+        retries = settings.BROADCAST_MAX_RETRIES if priority == API_PRIORITY_BULK else settings.TELEGRAM_RETRY_AFTER_ATTEMPTS
+        for attempt in range(retries + 1):
+            if limited:
+                started = time.perf_counter()
+                if priority == API_PRIORITY_BULK: await self.bulk_bucket.acquire()
+                if chat_id is not None: await self._wait_chat(chat_id)
+                await self._acquire(priority); metrics.api_queue_wait.labels("bulk" if priority == API_PRIORITY_BULK else "interactive").observe(time.perf_counter() - started)
+            try: return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= retries: raise
+                logger.warning(f"API limiti ({name}): {e.retry_after}s kutish."); await self.global_bucket.pause(e.retry_after)
+                if chat_id is not None: self.chat_next[chat_id] = max(self.chat_next.get(chat_id, 0.0), time.monotonic() + e.retry_after)
+                if not limited: await asyncio.sleep(e.retry_after)
+
+class BroadcastEngine:
+    ACTIVE_KEY = "broadcast:active"
+    def __init__(self, bot: Bot, redis_client: aioredis.Redis, session_pool: async_sessionmaker[AsyncSession]):
+        self.bot = bot; self.redis = redis_client; self.session_pool = session_pool; self.tasks: Dict[str, asyncio.Task] = {}
+    @staticmethod
+    def _key(job_id: str) -> str: return f"broadcast:{job_id}"
+    async def start(self, admin_chat_id: int, photo_file_id: str, post_text: str, total: int) -> str:
+        job_id = uuid.uuid4().hex[:12]; status_message = await self.bot.send_message(admin_chat_id, f"Reklama yuborish boshlandi... ({total} ta foydalanuvchiga)")
+        await self.redis.hset(self._key(job_id), mapping={"admin_chat_id": admin_chat_id, "status_message_id": status_message.message_id, "photo_file_id": photo_file_id, "post_text": post_text or "", "total": total, "cursor": 0, "success": 0, "failure": 0})
+        await self.redis.sadd(self.ACTIVE_KEY, job_id); self._spawn(job_id); return job_id
+    async def resume_all(self):
+        for job_id in await self.redis.smembers(self.ACTIVE_KEY):
+            if job_id not in self.tasks: logger.info(f"Reklama ({job_id}) to'xtagan joyidan davom ettirilmoqda."); self._spawn(job_id)
+    async def shutdown(self):
+        tasks = list(self.tasks.values())
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    async def supervise(self, interval: int = 60):
+        while True:
+            try: await self.resume_all()
+            except Exception as e: logger.error(f"Reklama ishlarini tiklashda xato: {e}")
+            await asyncio.sleep(interval)
+    def _spawn(self, job_id: str):
+        task = asyncio.create_task(self._run(job_id)); self.tasks[job_id] = task; task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+    async def _run(self, job_id: str):
+        lock_key = f"{self._key(job_id)}:owner"
+        if not await self.redis.set(lock_key, WORKER_ID, nx=True, ex=60): return
+        async def hold_lock():
+            while True: await asyncio.sleep(20); await self.redis.expire(lock_key, 60)
+        heartbeat = asyncio.create_task(hold_lock())
+        try: await self._process(job_id)
+        finally:
+            heartbeat.cancel()
+            if await self.redis.get(lock_key) == WORKER_ID: await self.redis.delete(lock_key)
+    async def _send(self, job: Dict[str, str], user_id: int) -> Tuple[int, str, Optional[str]]:
+        try: await self.bot.send_photo(chat_id=user_id, photo=job['photo_file_id'], caption=job['post_text']); return user_id, "sent", None
+        except TelegramRetryAfter: return user_id, "failed", "retry_after"
+        except TelegramForbiddenError as e: return user_id, "blocked", e.message
+        except TelegramBadRequest as e: return user_id, ("blocked" if "chat not found" in e.message.lower() else "failed"), e.message
+        except Exception as e: logger.error(f"Reklamani {user_id} ga yuborishda xato: {e}"); return user_id, "failed", str(e)
+    async def _report(self, job: Dict[str, str], success: int, failure: int, finished: bool = False):
+        text = (f"Yuborish yakunlandi.\n\n✅ Muvaffaqiyatli: <b>{success}</b>\n❌ Xatolik: <b>{failure}</b>" if finished
+                else f"Reklama yuborilmoqda... <b>{success + failure}</b>/{job['total']}\n\n✅ Muvaffaqiyatli: <b>{success}</b>\n❌ Xatolik: <b>{failure}</b>")
+        try: await self.bot.edit_message_text(text=text, chat_id=int(job['admin_chat_id']), message_id=int(job['status_message_id']))
+        except TelegramBadRequest: pass
+        except Exception as e: logger.warning(f"Reklama holatini yangilashda xato: {e}")
+    async def _process(self, job_id: str):
+        api_priority.set(API_PRIORITY_BULK); key = self._key(job_id); job = await self.redis.hgetall(key)
+        if not job: await self.redis.srem(self.ACTIVE_KEY, job_id); return
+        cursor, success, failure = int(job['cursor']), int(job['success']), int(job['failure'])
+        semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY); last_report = time.monotonic()
+        async def send(user_id: int) -> Tuple[int, str, Optional[str]]:
+            async with semaphore: return await self._send(job, user_id)
+        async for user_ids in iter_reachable_user_id_batches(self.session_pool, cursor, settings.BROADCAST_BATCH_SIZE):
+            results = await asyncio.gather(*(send(user_id) for user_id in user_ids))
+            sent = sum(1 for _, status, _ in results if status == "sent"); success += sent; failure += len(results) - sent; cursor = user_ids[-1]
+            for _, status, _ in results: metrics.broadcast_messages.labels(status).inc()
+            metrics.broadcast_remaining.labels(job_id).set(max(int(job['total']) - success - failure, 0))
+            async with self.session_pool() as session:
+                await log_broadcast_deliveries(session, job_id, results); await mark_users_unreachable(session, [u for u, status, _ in results if status == "blocked"]); await session.commit()
+            await self.redis.hset(key, mapping={"cursor": cursor, "success": success, "failure": failure})
+            if time.monotonic() - last_report >= settings.BROADCAST_PROGRESS_INTERVAL_SECONDS: await self._report(job, success, failure); last_report = time.monotonic()
+        await self._report(job, success, failure, finished=True); metrics.broadcast_remaining.remove(job_id)
+        await self.redis.srem(self.ACTIVE_KEY, job_id); await self.redis.expire(key, 7 * 24 * 3600)
+        logger.info(f"Reklama ({job_id}) yakunlandi: {success} muvaffaqiyatli, {failure} xato.")
 
 admin_router = Router(); admin_router.message.filter(F.from_user.id.in_(settings.ADMIN_IDS)); admin_router.callback_query.filter(F.from_user.id.in_(settings.ADMIN_IDS))
 user_router = Router()
+membership_router = Router()
 
 @admin_router.message(Command("admin", "polls"))
-async def cmd_admin_polls(message: Message, session: AsyncSession): await message.answer("Mavjud so'rovnomalar:", reply_markup=get_admin_poll_list_keyboard(await get_all_polls(session)))
+async def cmd_admin_polls(message: Message, session: AsyncSession): await message.answer("Mavjud so'rovnomalar:", reply_markup=get_admin_poll_list_keyboard(await get_polls_page(session)))
 @admin_router.callback_query(F.data == "admin:poll:list")
-async def cb_admin_poll_list(callback_query: CallbackQuery, session: AsyncSession): await callback_query.message.edit_text("Mavjud so'rovnomalar:", reply_markup=get_admin_poll_list_keyboard(await get_all_polls(session))); await callback_query.answer()
-@admin_router.callback_query(F.data == "admin:poll:create")
+async def cb_admin_poll_list(callback_query: CallbackQuery, session: AsyncSession): await callback_query.message.edit_text("Mavjud so'rovnomalar:", reply_markup=get_admin_poll_list_keyboard(await get_polls_page(session))); await callback_query.answer()
+@admin_router.callback_query(F.data.startswith("admin:poll:page:"))
+async def cb_admin_poll_page(callback_query: CallbackQuery, session: AsyncSession):
+    page = await get_polls_page_from_callback(session, callback_query.data)
+    try: await callback_query.message.edit_reply_markup(reply_markup=get_admin_poll_list_keyboard(page))
+    except TelegramBadRequest: pass
+    await callback_query.answer()
+@admin_router.callback_query(F.data == "admin:poll:create", flags={"db_session": False})
 async def cb_admin_poll_create(callback_query: CallbackQuery, state: FSMContext): await callback_query.message.edit_text("Yangi so'rovnoma uchun savolni yuboring:"); await state.set_state(AdminPollManagement.awaiting_poll_question); await callback_query.answer()
-@admin_router.message(AdminPollManagement.awaiting_poll_question)
+@admin_router.message(AdminPollManagement.awaiting_poll_question, flags={"db_session": False})
 async def process_poll_question(message: Message, state: FSMContext): await state.update_data(question=message.text); await message.answer("Variantlarni yuboring (har biri yangi qatorda, kamida 2ta):\nVariant A\nVariant B"); await state.set_state(AdminPollManagement.awaiting_poll_options)
 @admin_router.message(AdminPollManagement.awaiting_poll_options)
 async def process_poll_options(message: Message, state: FSMContext, session: AsyncSession):
     options_list = [opt.strip() for opt in message.text.split('\n') if opt.strip()]; options_dict = {str(i+1): opt for i, opt in enumerate(options_list)}; data = await state.get_data()
     if len(options_list) < 2: return await message.answer("Kamida 2 ta variant kerak.")
     poll = await create_poll(session, data["question"], options_dict, message.from_user.id); await message.answer(f"So'rovnoma '{poll.question}' yaratildi!")
-    await state.clear(); await message.answer("Mavjud so'rovnomalar:", reply_markup=get_admin_poll_list_keyboard(await get_all_polls(session)))
+    await state.clear(); await message.answer("Mavjud so'rovnomalar:", reply_markup=get_admin_poll_list_keyboard(await get_polls_page(session)))
 @admin_router.callback_query(F.data.startswith("admin:poll:view:"))
 async def cb_admin_poll_view(callback_query: CallbackQuery, session: AsyncSession):
     poll_id = int(callback_query.data.split(":")[-1]); poll = await get_poll_by_id(session, poll_id)
@@ -216,7 +1092,7 @@ async def cb_admin_poll_toggle(callback_query: CallbackQuery, session: AsyncSess
 async def cb_admin_poll_results(callback_query: CallbackQuery, session: AsyncSession):
     poll_id = int(callback_query.data.split(":")[-1]); poll = await get_poll_by_id(session, poll_id)
     if not poll: return await callback_query.answer("So'rovnoma topilmadi!", show_alert=True)
-    results = await get_poll_results(session, poll_id); text = f"📊 <b>'{poll.question}'</b> natijalari:\n\n"
+    results = await vote_counters.get_or_rebuild(session, poll_id); text = f"📊 <b>'{poll.question}'</b> natijalari:\n\n"
     if not results: text += "Hali ovozlar yo'q."
     else:
         total_votes = sum(results.values())
@@ -228,14 +1104,20 @@ async def cb_admin_poll_results(callback_query: CallbackQuery, session: AsyncSes
 
 @admin_router.message(Command("rek"))
 async def cmd_create_ad(message: Message, session: AsyncSession, state: FSMContext):
-    all_polls = await get_all_polls(session);
-    if not all_polls: return await message.answer("Reklama uchun avval so'rovnoma yarating.")
-    await message.answer("Reklama posti uchun so'rovnomani tanlang:", reply_markup=get_poll_selection_for_ad_keyboard(all_polls)); await state.set_state(AdCreation.awaiting_poll_selection)
-@admin_router.callback_query(F.data.startswith("ad_select_poll:"), AdCreation.awaiting_poll_selection)
+    page = await get_polls_page(session, title_length=40)
+    if not page.items: return await message.answer("Reklama uchun avval so'rovnoma yarating.")
+    await message.answer("Reklama posti uchun so'rovnomani tanlang:", reply_markup=get_poll_selection_for_ad_keyboard(page)); await state.set_state(AdCreation.awaiting_poll_selection)
+@admin_router.callback_query(F.data.startswith("ad_poll_page:"), AdCreation.awaiting_poll_selection)
+async def cb_ad_poll_page(callback_query: CallbackQuery, session: AsyncSession):
+    page = await get_polls_page_from_callback(session, callback_query.data, title_length=40)
+    try: await callback_query.message.edit_reply_markup(reply_markup=get_poll_selection_for_ad_keyboard(page))
+    except TelegramBadRequest: pass
+    await callback_query.answer()
+@admin_router.callback_query(F.data.startswith("ad_select_poll:"), AdCreation.awaiting_poll_selection, flags={"db_session": False})
 async def cb_ad_poll_selected(callback_query: CallbackQuery, state: FSMContext):
     poll_id = int(callback_query.data.split(":")[1]); await state.update_data(poll_id=poll_id)
     await callback_query.message.edit_text("Ajoyib! Endi reklama matnini yuboring."); await state.set_state(AdCreation.awaiting_post_text)
-@admin_router.message(AdCreation.awaiting_post_text)
+@admin_router.message(AdCreation.awaiting_post_text, flags={"db_session": False})
 async def process_ad_text(message: Message, state: FSMContext): await state.update_data(post_text=message.html_text); await message.answer("Matn qabul qilindi. Endi post uchun suratni yuboring."); await state.set_state(AdCreation.awaiting_post_photo)
 @admin_router.message(F.photo, AdCreation.awaiting_post_photo)
 async def process_ad_photo(message: Message, state: FSMContext, session: AsyncSession, bot: Bot):
@@ -245,92 +1127,85 @@ async def process_ad_photo(message: Message, state: FSMContext, session: AsyncSe
     await message.answer("Tayyor post. Buni kerakli kanallarga yuborishingiz mumkin:")
     await bot.send_photo(chat_id=message.chat.id, photo=message.photo[-1].file_id, caption=data.get("post_text"), reply_markup=keyboard)
     await state.clear()
-@admin_router.message(AdCreation.awaiting_post_photo)
+@admin_router.message(AdCreation.awaiting_post_photo, flags={"db_session": False})
 async def process_ad_photo_invalid(message: Message): await message.reply("Iltimos, faqat surat (rasm) yuboring.")
 
-@admin_router.message(Command("send_ad"))
+@admin_router.message(Command("send_ad"), flags={"db_session": False})
 async def cmd_broadcast_start(message: Message, state: FSMContext): await state.set_state(Broadcast.awaiting_ad_text); await message.answer("Barcha foydalanuvchilarga yuborish uchun reklama matnini yuboring.\n\nBekor qilish uchun: /bekor_qilish")
-@admin_router.message(Command("bekor_qilish"), F.state.in_(AdCreation.__all_states__ + Broadcast.__all_states__))
+@admin_router.message(Command("bekor_qilish"), F.state.in_(AdCreation.__all_states__ + Broadcast.__all_states__), flags={"db_session": False})
 async def cancel_any_state(message: Message, state: FSMContext): await state.clear(); await message.answer("Jarayon bekor qilindi.", reply_markup=remove_keyboard)
-@admin_router.message(Broadcast.awaiting_ad_text)
+@admin_router.message(Broadcast.awaiting_ad_text, flags={"db_session": False})
 async def broadcast_get_text(message: Message, state: FSMContext): await state.update_data(post_text=message.html_text); await state.set_state(Broadcast.awaiting_ad_photo); await message.answer("Matn qabul qilindi. Endi post uchun suratni yuboring.")
 @admin_router.message(F.photo, Broadcast.awaiting_ad_photo)
 async def broadcast_get_photo(message: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     await state.update_data(photo_file_id=message.photo[-1].file_id); data = await state.get_data()
-    user_count = len(await get_all_user_ids(session)); await state.update_data(user_count=user_count)
+    user_count = await count_reachable_users(session); await state.update_data(user_count=user_count)
     await bot.send_photo(chat_id=message.from_user.id, photo=data['photo_file_id'], caption=data['post_text'])
     await message.answer(f"Post tayyor. <b>{user_count}</b> ta foydalanuvchiga yuborilsinmi?\n\nTasdiqlash uchun <b>ha</b> deb yozing.", parse_mode=ParseMode.HTML); await state.set_state(Broadcast.awaiting_confirmation)
-@admin_router.message(Broadcast.awaiting_confirmation)
-async def broadcast_confirmation(message: Message, state: FSMContext, session: AsyncSession, bot: Bot):
-    if message.text.lower() != 'ha': await state.clear(); return await message.answer("Reklama yuborish bekor qilindi.")
-    data = await state.get_data(); user_ids = await get_all_user_ids(session); await state.clear();
-    await message.answer(f"Reklama yuborish boshlandi... ({len(user_ids)} ta foydalanuvchiga)")
-    success, failure = 0, 0
-    for user_id in user_ids:
-        try: await bot.send_photo(chat_id=user_id, photo=data['photo_file_id'], caption=data['post_text']); success += 1; await asyncio.sleep(0.1)
-        except TelegramRetryAfter as e: logger.warning(f"API limiti: {e.retry_after}s kutish."); await asyncio.sleep(e.retry_after); success-=1
-        except (TelegramForbiddenError, TelegramBadRequest): failure += 1
-        except Exception as e: logger.error(f"Reklamani {user_id} ga yuborishda xato: {e}"); failure += 1
-    await message.answer(f"Yuborish yakunlandi.\n\n✅ Muvaffaqiyatli: <b>{success}</b>\n❌ Xatolik: <b>{failure}</b>")
-
-@user_router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext, session: AsyncSession, bot: Bot, command: CommandObject = None):
-    await state.clear(); await get_or_create_user(session, message.from_user.id, message.from_user.username, message.from_user.first_name)
-    unsubscribed = await check_all_channels_membership(bot, message.from_user.id)
+@admin_router.message(Broadcast.awaiting_confirmation, flags={"db_session": False})
+async def broadcast_confirmation(message: Message, state: FSMContext, broadcast_engine: BroadcastEngine):
+    if not message.text or message.text.lower() != 'ha': await state.clear(); return await message.answer("Reklama yuborish bekor qilindi.")
+    data = await state.get_data(); await state.clear()
+    await broadcast_engine.start(message.chat.id, data['photo_file_id'], data['post_text'], data.get('user_count', 0))
+
+@user_router.message(CommandStart(), flags={"throttle": "start"})
+async def cmd_start(message: Message, state: FSMContext, session: AsyncSession, check_membership: MembershipChecker, command: CommandObject = None):
+    await state.clear(); await known_users.ensure(session, message.from_user.id, message.from_user.username, message.from_user.first_name)
+    unsubscribed = await check_membership(message.from_user.id)
     if command and command.args:
         try:
             _, poll_id_str, choice_key = command.args.split("_"); poll_id = int(poll_id_str)
             if unsubscribed: await message.answer("Ovoz berishdan avval kanallarga a'zo bo'ling:", reply_markup=get_channel_subscription_keyboard(unsubscribed)); await state.set_data({'deep_link_vote': (poll_id, choice_key)}); await state.set_state(VotingProcess.awaiting_subscription_check); return
-            await process_deep_link_vote(message, session, bot, poll_id, choice_key); return
+            await process_deep_link_vote(message, session, check_membership, poll_id, choice_key); return
         except (ValueError, IndexError): pass
     if unsubscribed: await message.answer("Assalomu alaykum! Ishtirok etish uchun kanallarga a'zo bo'ling:", reply_markup=get_channel_subscription_keyboard(unsubscribed)); await state.set_state(VotingProcess.awaiting_subscription_check)
     else: await message.answer("Assalomu alaykum! Ovoz berish uchun telefon raqamingizni yuboring:", reply_markup=get_contact_keyboard()); await state.set_state(VotingProcess.awaiting_contact)
 
-async def process_deep_link_vote(message: Message, session: AsyncSession, bot: Bot, poll_id: int, choice_key: str):
-    user_id = message.from_user.id; poll = await get_poll_by_id(session, poll_id)
+async def process_deep_link_vote(message: Message, session: AsyncSession, check_membership: MembershipChecker, poll_id: int, choice_key: str, user_id: Optional[int] = None):
+    user_id = user_id or message.from_user.id; poll = await get_poll_by_id(session, poll_id)
     if not poll or not poll.is_active: return await message.answer("Afsuski, bu so'rovnoma aktiv emas.")
     if await has_user_voted(session, user_id, poll_id): return await message.answer("Siz bu so'rovnomada allaqachon ovoz bergansiz.")
-    unsubscribed = await check_all_channels_membership(bot, user_id)
+    unsubscribed = await check_membership(user_id)
     if unsubscribed: return await message.answer("Ovoz berish uchun, iltimos, avval kanallarga a'zo bo'ling:", reply_markup=get_channel_subscription_keyboard(unsubscribed))
     try: await add_vote(session, user_id, poll_id, choice_key); choice_text = poll.options.get(choice_key, ""); await message.answer(f"✅ Rahmat! Ovozingiz qabul qilindi: <b>\"{choice_text}\"</b>.")
     except Exception as e: logger.error(f"Deep link ovoz berishda xato: {e}"); await message.answer("Xatolik yuz berdi.")
 
 @user_router.callback_query(F.data=="check_subscription", VotingProcess.awaiting_subscription_check)
-async def cb_check_subscription(callback_query: CallbackQuery, state: FSMContext, bot: Bot, session: AsyncSession):
+async def cb_check_subscription(callback_query: CallbackQuery, state: FSMContext, check_membership: MembershipChecker, session: AsyncSession):
     await callback_query.answer("Tekshirilmoqda...", cache_time=1)
-    unsubscribed = await check_all_channels_membership(bot, callback_query.from_user.id)
+    unsubscribed = await check_membership(callback_query.from_user.id, fresh=True)
     if unsubscribed: await callback_query.message.edit_text("Afsuski, hali ham barcha kanallarga a'zo emassiz.", reply_markup=get_channel_subscription_keyboard(unsubscribed, "🔄 Qayta tekshirish"))
     else:
         await callback_query.message.delete(); data = await state.get_data(); deep_link_vote = data.get('deep_link_vote')
-        if deep_link_vote: poll_id, choice_key = deep_link_vote; await process_deep_link_vote(callback_query.message, session, bot, poll_id, choice_key); await state.clear(); return
+        if deep_link_vote: poll_id, choice_key = deep_link_vote; await process_deep_link_vote(callback_query.message, session, check_membership, poll_id, choice_key, callback_query.from_user.id); await state.clear(); return
         await callback_query.message.answer("Rahmat! Endi telefon raqamingizni yuboring:", reply_markup=get_contact_keyboard()); await state.set_state(VotingProcess.awaiting_contact)
 @user_router.message(F.contact, VotingProcess.awaiting_contact)
 async def handle_contact(message: Message, state: FSMContext, session: AsyncSession, crypto_service: CryptoService, captcha_service: CaptchaService):
     if await captcha_service.is_user_blocked(message.from_user.id): await message.answer(f"Siz {settings.CAPTCHA_BLOCK_DURATION_MINUTES} daqiqaga bloklangansiz.", reply_markup=remove_keyboard); await state.clear(); return
     await save_user_phone(session, message.from_user.id, crypto_service.encrypt(message.contact.phone_number))
     question = await captcha_service.create_captcha(message.from_user.id); await message.answer(f"Raqam qabul qilindi. Bot emasligingizni tasdiqlang ({settings.CAPTCHA_TIMEOUT_SECONDS}s):\n<b>{question}</b>", reply_markup=remove_keyboard); await state.set_state(VotingProcess.awaiting_captcha)
-@user_router.message(VotingProcess.awaiting_contact)
+@user_router.message(VotingProcess.awaiting_contact, flags={"db_session": False})
 async def invalid_contact_input(message: Message): await message.reply("Iltimos, 'Telefon raqamni yuborish 📞' tugmasi orqali yuboring.")
-@user_router.message(VotingProcess.awaiting_captcha)
+@user_router.message(VotingProcess.awaiting_captcha, flags={"throttle": "captcha"})
 async def process_captcha_answer(message: Message, state: FSMContext, session: AsyncSession, captcha_service: CaptchaService):
     user_id = message.from_user.id
-    if await captcha_service.is_user_blocked(user_id): await message.answer("Siz vaqtinchalik bloklangansiz."); await state.clear(); return
-    is_correct = await captcha_service.verify_captcha(user_id, message.text)
-    if is_correct:
+    result = await captcha_service.check_captcha(user_id, message.text or "")
+    if result.status == "blocked": await message.answer("Siz vaqtinchalik bloklangansiz."); await state.clear(); return
+    if result.status == "correct":
         await message.answer("✅ To'g'ri!"); active_poll = await get_active_poll(session)
         if not active_poll: await message.answer("Hozircha aktiv so'rovnomalar yo'q."); await state.clear(); return
         if await has_user_voted(session, user_id, active_poll.id): await message.answer("Siz bu so'rovnomada allaqachon ovoz bergansiz."); await state.clear(); return
         await message.answer(f"So'rovnoma:\n<b>{active_poll.question}</b>\n\nVariantni tanlang:", reply_markup=get_poll_options_keyboard(active_poll)); await state.set_state(VotingProcess.awaiting_vote_choice)
-    else:
-        if await captcha_service.is_user_blocked(user_id): await message.answer(f"Noto'g'ri. Urinishlar tugadi. Siz {settings.CAPTCHA_BLOCK_DURATION_MINUTES} daqiqaga bloklandingiz."); await state.clear()
-        else: attempts_left = await captcha_service.get_attempts_left(user_id); await message.answer(f"Noto'g'ri. Yana {attempts_left} ta urinish qoldi.")
+    elif result.status == "exhausted": await message.answer(f"Noto'g'ri. Urinishlar tugadi. Siz {settings.CAPTCHA_BLOCK_DURATION_MINUTES} daqiqaga bloklandingiz."); await state.clear()
+    elif result.status == "expired": await message.answer("CAPTCHA vaqti tugadi. Qaytadan boshlash uchun /start bosing."); await state.clear()
+    else: await message.answer(f"Noto'g'ri. Yana {result.attempts_left} ta urinish qoldi.")
 
 @user_router.callback_query(F.data.startswith("vote_poll:"), VotingProcess.awaiting_vote_choice)
-async def process_vote_choice(callback_query: CallbackQuery, state: FSMContext, session: AsyncSession, bot: Bot):
+async def process_vote_choice(callback_query: CallbackQuery, state: FSMContext, session: AsyncSession, check_membership: MembershipChecker):
     try: _, poll_id_str, _, choice_key = callback_query.data.split(":"); poll_id = int(poll_id_str)
     except (ValueError, IndexError): await callback_query.answer("Xato!", show_alert=True); return
     user_id = callback_query.from_user.id
-    unsubscribed_channels = await check_all_channels_membership(bot, user_id)
+    unsubscribed_channels = await check_membership(user_id)
     if unsubscribed_channels:
         await callback_query.message.answer("❌ Kechirasiz, ovoz berish uchun avval kanallarga a'zo bo'lishingiz shart.", reply_markup=get_channel_subscription_keyboard(unsubscribed_channels, "✅ A'zo bo'ldim, qayta ovoz berish"))
         await callback_query.answer("Iltimos, avval kanallarga to'liq a'zo bo'ling.", show_alert=True); return
@@ -344,34 +1219,259 @@ async def process_vote_choice(callback_query: CallbackQuery, state: FSMContext,
     except Exception as e: logger.error(f"Ovoz berishda xato: {e}"); await callback_query.message.edit_text("Texnik nosozlik."); await callback_query.answer("Xatolik!", show_alert=True)
     await state.clear()
 
-async def main():
+@membership_router.chat_member(flags={"db_session": False})
+async def on_channel_member_updated(event: ChatMemberUpdated, membership_index: MembershipIndex):
+    channel_id = match_required_channel(event.chat)
+    if channel_id is None: return
+    await membership_index.set_many(event.new_chat_member.user.id, {channel_id: event.new_chat_member.status in ("member", "administrator", "creator")})
+
+async def run_exclusive(redis_client: aioredis.Redis, name: str, job: Callable[[], Awaitable[Any]], ttl: int = 60, slots: Optional[asyncio.Semaphore] = None):
+    key = f"job_lock:{name}"
+    while True:
+        has_slot = False
+        if slots:
+            try: await asyncio.wait_for(slots.acquire(), timeout=ttl * 2); has_slot = True
+            except asyncio.TimeoutError: pass
+        try:
+            if await redis_client.set(key, WORKER_ID, nx=True, ex=ttl):
+                logger.info(f"'{name}' fon vazifasi shu jarayonda ishga tushdi ({WORKER_ID}).")
+                task = asyncio.create_task(job())
+                try:
+                    while not task.done():
+                        await asyncio.wait({task}, timeout=ttl / 3)
+                        if not task.done() and (await redis_client.get(key) != WORKER_ID or not await redis_client.expire(key, ttl)):
+                            logger.warning(f"'{name}' fon vazifasi qulfi yo'qotildi."); break
+                finally:
+                    task.cancel(); await asyncio.gather(task, return_exceptions=True)
+                    if await redis_client.get(key) == WORKER_ID: await redis_client.delete(key)
+        finally:
+            if has_slot: slots.release()
+        await asyncio.sleep(ttl / 2)
+
+class UpdateQueue:
+    GROUP = "dispatchers"
+    def __init__(self, redis_client: aioredis.Redis):
+        self.redis = redis_client; self.prefix = settings.UPDATE_QUEUE_PREFIX; self.partitions = settings.UPDATE_QUEUE_PARTITIONS
+    def stream(self, partition: int) -> str: return f"{self.prefix}:{partition}"
+    @property
+    def dead_letter(self) -> str: return f"{self.prefix}:dead"
+    @staticmethod
+    def partition_key(payload: Dict[str, Any]) -> int:
+        for key, value in payload.items():
+            if key == "update_id" or not isinstance(value, dict): continue
+            sender = value.get("from") or value.get("user") or value.get("chat") or {}
+            return abs(int(sender.get("id") or 0))
+        return 0
+    async def push(self, raw: Union[bytes, str]):
+        partition = self.partition_key(json.loads(raw)) % self.partitions
+        await self.redis.xadd(self.stream(partition), {"u": raw if isinstance(raw, str) else raw.decode()})
+    async def ensure_groups(self):
+        for partition in range(self.partitions):
+            try: await self.redis.xgroup_create(self.stream(partition), self.GROUP, id="0", mkstream=True)
+            except RedisResponseError as e:
+                if "BUSYGROUP" not in str(e): raise
+    async def _ack(self, stream: str, entry_id: str):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xack(stream, self.GROUP, entry_id); pipe.xdel(stream, entry_id); pipe.hdel(f"{stream}:attempts", entry_id); await pipe.execute()
+    async def _handle(self, stream: str, entry_id: str, fields: Optional[Dict[str, str]], bot: Bot, dp: Dispatcher):
+        while fields:
+            try: await dp.feed_update(bot, Update.model_validate(json.loads(fields["u"]), context={"bot": bot})); break
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                attempts = await self.redis.hincrby(f"{stream}:attempts", entry_id, 1)
+                if attempts >= settings.UPDATE_QUEUE_MAX_DELIVERIES:
+                    await self.redis.xadd(self.dead_letter, {"u": fields["u"], "stream": stream, "error": str(e)[:500]})
+                    logger.error(f"Update {entry_id} ({stream}) {attempts} urinishdan so'ng dead-letter oqimiga o'tkazildi: {e}", exc_info=True); break
+                logger.warning(f"Update {entry_id} ({stream}) qayta ishlanmadi ({attempts}-urinish): {e}"); await asyncio.sleep(min(2 ** attempts, 30))
+        await self._ack(stream, entry_id)
+    async def consume(self, partition: int, bot: Bot, dp: Dispatcher):
+        stream = self.stream(partition); start_id = "0-0"
+        while True:
+            start_id, *_ = await self.redis.xautoclaim(stream, self.GROUP, WORKER_ID, min_idle_time=0, start_id=start_id, count=settings.UPDATE_QUEUE_BATCH_SIZE)
+            if start_id == "0-0": break
+        last_id = "0"
+        while True:
+            entries = await self.redis.xreadgroup(self.GROUP, WORKER_ID, {stream: last_id}, count=settings.UPDATE_QUEUE_BATCH_SIZE, block=None if last_id == "0" else 5000)
+            messages = entries[0][1] if entries else []
+            if last_id == "0" and not messages: last_id = ">"; continue
+            for entry_id, fields in messages: await self._handle(stream, entry_id, fields, bot, dp)
+    async def stats(self) -> Dict[str, int]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for partition in range(self.partitions): pipe.xlen(self.stream(partition)); pipe.xpending(self.stream(partition), self.GROUP)
+            pipe.xlen(self.dead_letter); results = await pipe.execute(raise_on_error=False)
+        depths = [r if isinstance(r, int) else 0 for r in results[0:-1:2]]
+        pending = [r.get("pending", 0) if isinstance(r, dict) else 0 for r in results[1:-1:2]]
+        return {"depth": sum(depths), "max_partition_depth": max(depths, default=0), "pending": sum(pending), "dead": results[-1] if isinstance(results[-1], int) else 0}
+
+async def log_update_queue_stats(queue: UpdateQueue):
+    while True:
+        await asyncio.sleep(settings.UPDATE_QUEUE_STATS_LOG_SECONDS)
+        try:
+            stats = await queue.stats()
+            for name, value in stats.items(): metrics.update_queue.labels(name).set(value)
+            logger.info(f"Update navbati: chuqurlik={stats['depth']}, eng katta bo'lim={stats['max_partition_depth']}, qayta ishlanmoqda={stats['pending']}, dead-letter={stats['dead']}")
+        except Exception as e: logger.error(f"Update navbati statistikasini olishda xato: {e}")
+
+def create_redis_client(db: int) -> aioredis.Redis:
     redis_connection_params = {"host": settings.REDIS_HOST, "port": settings.REDIS_PORT}
     if settings.REDIS_PASSWORD: redis_connection_params["password"] = settings.REDIS_PASSWORD
+    return aioredis.Redis(db=db, decode_responses=True, **redis_connection_params)
+
+def build_dispatcher(worker_id: int = 0, session: Optional[BaseSession] = None) -> Tuple[Bot, Dispatcher]:
+    redis_fsm_client = create_redis_client(settings.REDIS_DB_FSM)
+    redis_captcha_client = create_redis_client(settings.REDIS_DB_CAPTCHA)
+    redis_cache_client = create_redis_client(settings.REDIS_DB_CACHE)
     
-    redis_fsm_client = aioredis.Redis(db=settings.REDIS_DB_FSM, decode_responses=True, **redis_connection_params)
-    redis_captcha_client = aioredis.Redis(db=settings.REDIS_DB_CAPTCHA, decode_responses=True, **redis_connection_params)
-    
-    storage = RedisStorage(redis=redis_fsm_client)
+    storage = RedisStorage(redis=redis_fsm_client, state_ttl=settings.FSM_STATE_TTL_SECONDS, data_ttl=settings.FSM_DATA_TTL_SECONDS, json_dumps=fsm_json_dumps, json_loads=fsm_json_loads)
     captcha_service = CaptchaService(redis_client=redis_captcha_client)
     crypto_service = CryptoService(settings.ENCRYPTION_KEY)
+    membership_cache = MembershipCache(redis_client=redis_cache_client)
+    membership_index = MembershipIndex(redis_client=redis_cache_client) if settings.MEMBERSHIP_INDEX_ENABLED else None
+    channel_info = ChannelInfoCache()
+    vote_counters.attach(redis_cache_client); known_users.attach(redis_cache_client)
+    if settings.VOTE_WRITE_BEHIND_ENABLED: vote_ingestor.attach(redis_cache_client, AsyncSessionFactory)
     
-    bot = Bot(token=settings.BOT_TOKEN.get_secret_value(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot = Bot(token=settings.BOT_TOKEN.get_secret_value(), session=session or TunedAiohttpSession(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    metrics.setup(); bot.session.middleware(RateScheduler(redis_cache_client))
+    if metrics.enabled: bot.session.middleware(ApiMetricsMiddleware())
+    broadcast_engine = BroadcastEngine(bot=bot, redis_client=redis_cache_client, session_pool=AsyncSessionFactory)
     dp = Dispatcher(storage=storage)
 
-    dp.update.middleware(DbSessionMiddleware(pool=AsyncSessionFactory))
-    dp.workflow_data.update({"crypto_service": crypto_service, "captcha_service": captcha_service, "bot": bot})
+    if metrics.enabled:
+        metrics_middleware = MetricsMiddleware()
+        for observer in (dp.message, dp.callback_query, dp.chat_member): observer.middleware(metrics_middleware)
+    if settings.THROTTLE_ENABLED:
+        throttling_middleware = ThrottlingMiddleware(redis_client=redis_cache_client)
+        for observer in (dp.message, dp.callback_query): observer.middleware(throttling_middleware)
+    db_session_middleware = DbSessionMiddleware(pool=AsyncSessionFactory)
+    for observer in (dp.message, dp.callback_query, dp.chat_member): observer.middleware(db_session_middleware)
+    dp.update.middleware(MembershipMiddleware(membership_cache=membership_cache, membership_index=membership_index, channel_info=channel_info))
+    dp.workflow_data.update({"crypto_service": crypto_service, "captcha_service": captcha_service, "membership_index": membership_index, "broadcast_engine": broadcast_engine, "bot": bot,
+                             "channel_info": channel_info, "db_session_middleware": db_session_middleware, "redis_clients": [redis_fsm_client, redis_captcha_client, redis_cache_client], "worker_id": worker_id})
 
     dp.include_router(admin_router); dp.include_router(user_router)
+    if membership_index: dp.include_router(membership_router)
+    dp.startup.register(on_startup); dp.shutdown.register(on_shutdown)
+    return bot, dp
+
+async def on_startup(dispatcher: Dispatcher, bot: Bot):
+    redis_fsm_client, redis_captcha_client, redis_cache_client = dispatcher["redis_clients"]
+    await redis_fsm_client.ping(); logger.info("FSM uchun Redis'ga ulanish muvaffaqiyatli.")
+    await redis_captcha_client.ping(); logger.info("CAPTCHA uchun Redis'ga ulanish muvaffaqiyatli.")
+    await redis_cache_client.ping(); logger.info("Kesh uchun Redis'ga ulanish muvaffaqiyatli.")
+    if settings.DB_TYPE.lower() == "postgresql" and settings.DB_POOL_WARMUP: await warm_up_pool(engine, settings.DB_POOL_SIZE)
+    channel_info: ChannelInfoCache = dispatcher["channel_info"]; broadcast_engine: BroadcastEngine = dispatcher["broadcast_engine"]; membership_index = dispatcher["membership_index"]
+    await channel_info.refresh(bot)
+    jobs = [poll_cache.listen(redis_cache_client), known_users.listen(redis_cache_client), run_channel_info_refresh(bot, channel_info), log_db_session_stats(dispatcher["db_session_middleware"]), log_pool_stats(engine), broadcast_engine.supervise(),
+            run_exclusive(redis_cache_client, "vote_counters", lambda: run_vote_counters_reconciliation(AsyncSessionFactory))]
+    if vote_ingestor.enabled: jobs.append(vote_ingestor.run())
+    if membership_index: jobs.append(run_exclusive(redis_cache_client, "membership_index", lambda: run_membership_index_jobs(bot, membership_index)))
+    if metrics.enabled: metrics.start_server(dispatcher["worker_id"]); jobs.append(run_metrics_probes(engine, redis_cache_client))
+    dispatcher["background_tasks"] = [asyncio.create_task(job) for job in jobs]
+    if settings.BOT_MODE.lower() == "webhook" and dispatcher["worker_id"] == 0: await register_webhook(bot, dispatcher.resolve_used_update_types())
+
+async def register_webhook(bot: Bot, allowed_updates: List[str]):
+    await bot.set_webhook(url=f"{settings.WEBHOOK_BASE_URL.rstrip('/')}{settings.WEBHOOK_PATH}", secret_token=settings.WEBHOOK_SECRET.get_secret_value() if settings.WEBHOOK_SECRET else None,
+                          allowed_updates=allowed_updates, drop_pending_updates=settings.WEBHOOK_DROP_PENDING_UPDATES)
+    logger.info(f"Webhook o'rnatildi: {settings.WEBHOOK_BASE_URL}{settings.WEBHOOK_PATH}")
+
+async def on_shutdown(dispatcher: Dispatcher, bot: Bot):
+    background_tasks = dispatcher.workflow_data.get("background_tasks", [])
+    for task in background_tasks: task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True); await dispatcher["broadcast_engine"].shutdown()
+    await close_dispatcher_resources(dispatcher, bot); logger.info("Bot to'xtatildi.")
+
+async def close_dispatcher_resources(dispatcher: Dispatcher, bot: Bot):
+    for client in dispatcher["redis_clients"]: await client.close()
+    await bot.session.close()
+
+async def run_polling():
     await create_db_and_tables()
+    bot, dp = build_dispatcher()
     logger.info(f"Bot Redis va {settings.DB_TYPE.upper()} bilan ishga tushirilmoqda...")
-    try:
-        await redis_fsm_client.ping(); logger.info("FSM uchun Redis'ga ulanish muvaffaqiyatli.")
-        await redis_captcha_client.ping(); logger.info("CAPTCHA uchun Redis'ga ulanish muvaffaqiyatli.")
-        await bot.delete_webhook(drop_pending_updates=True); await dp.start_polling(bot)
+    try: await bot.delete_webhook(drop_pending_updates=True); await dp.start_polling(bot)
     except RedisConnectionError as e: logger.critical(f"Redis serveriga ulanib bo'lmadi: {e}. Sozlamalarni tekshiring.")
     except Exception as e: logger.critical(f"Botni ishga tushirishda kutilmagan xatolik: {e}", exc_info=True)
-    finally: await bot.session.close(); await redis_fsm_client.close(); await redis_captcha_client.close(); logger.info("Bot to'xtatildi.")
+    finally: await close_dispatcher_resources(dp, bot)
+
+def run_update_receiver(worker_id: int):
+    app = web.Application(); app["queue"] = UpdateQueue(create_redis_client(settings.REDIS_DB_CACHE))
+    secret = settings.WEBHOOK_SECRET.get_secret_value() if settings.WEBHOOK_SECRET else None
+    async def receive(request: web.Request) -> web.Response:
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret: return web.Response(status=401)
+        await app["queue"].push(await request.read()); return web.Response()
+    async def on_receiver_startup(_: web.Application):
+        await app["queue"].redis.ping()
+        if worker_id == 0:
+            bot, dp = build_dispatcher()
+            try: await register_webhook(bot, dp.resolve_used_update_types())
+            finally: await close_dispatcher_resources(dp, bot)
+    async def on_receiver_cleanup(_: web.Application): await app["queue"].redis.close()
+    app.router.add_post(settings.WEBHOOK_PATH, receive); app.on_startup.append(on_receiver_startup); app.on_cleanup.append(on_receiver_cleanup)
+    logger.info(f"Update qabul qiluvchi #{worker_id} {settings.WEBAPP_HOST}:{settings.WEBAPP_PORT} da ishga tushmoqda ({WORKER_ID}).")
+    web.run_app(app, host=settings.WEBAPP_HOST, port=settings.WEBAPP_PORT, reuse_port=settings.WEB_WORKERS > 1, print=None)
+
+async def run_update_consumer(worker_id: int):
+    bot, dp = build_dispatcher(worker_id); redis_cache_client = dp["redis_clients"][2]
+    queue = UpdateQueue(redis_cache_client); slots = asyncio.Semaphore(-(-queue.partitions // max(1, settings.UPDATE_CONSUMERS)))
+    tasks: List[asyncio.Task] = []; started = False
+    try:
+        await queue.ensure_groups(); await dp.emit_startup(dispatcher=dp, **dp.workflow_data); started = True
+        logger.info(f"Update iste'molchisi #{worker_id} ishga tushdi ({WORKER_ID}), bo'limlar: {queue.partitions}.")
+        tasks = [asyncio.create_task(run_exclusive(redis_cache_client, f"updates:{p}", partial(queue.consume, p, bot, dp), ttl=settings.UPDATE_QUEUE_LEASE_SECONDS, slots=slots)) for p in range(queue.partitions)]
+        tasks.append(asyncio.create_task(log_update_queue_stats(queue)))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if started: await dp.emit_shutdown(dispatcher=dp, **dp.workflow_data)
+        else: await close_dispatcher_resources(dp, bot)
+
+def run_update_consumer_process(worker_id: int):
+    try: asyncio.run(run_update_consumer(worker_id))
+    except (KeyboardInterrupt, SystemExit): pass
+
+def run_processes(target: Callable[[int], Any], count: int, name: str):
+    context = multiprocessing.get_context("spawn")
+    def spawn(i: int):
+        worker = context.Process(target=target, args=(i,), name=f"{name}-{i}"); worker.start(); return worker
+    workers = {i: spawn(i) for i in range(count)}
+    try:
+        while workers:
+            multiprocessing.connection.wait([worker.sentinel for worker in workers.values()])
+            for i, worker in list(workers.items()):
+                if worker.is_alive(): continue
+                if worker.exitcode == 0: del workers[i]; continue
+                logger.error(f"{worker.name} jarayoni to'xtadi (exitcode={worker.exitcode}), qayta ishga tushirilmoqda."); time.sleep(1); workers[i] = spawn(i)
+    finally:
+        for worker in workers.values():
+            if worker.is_alive(): worker.terminate()
+
+def run_consumers():
+    asyncio.run(create_db_and_tables())
+    if settings.UPDATE_CONSUMERS <= 1: return run_update_consumer_process(0)
+    run_processes(run_update_consumer_process, settings.UPDATE_CONSUMERS, "update-consumer")
+
+def run_webhook_worker(worker_id: int):
+    if settings.UPDATE_QUEUE_ENABLED: return run_update_receiver(worker_id)
+    bot, dp = build_dispatcher(worker_id); app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=settings.WEBHOOK_SECRET.get_secret_value() if settings.WEBHOOK_SECRET else None).register(app, path=settings.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    async def on_worker_cleanup(_: web.Application): await close_dispatcher_resources(dp, bot)
+    app.on_cleanup.append(on_worker_cleanup)
+    logger.info(f"Webhook ishchisi #{worker_id} {settings.WEBAPP_HOST}:{settings.WEBAPP_PORT} da ishga tushmoqda ({WORKER_ID}).")
+    web.run_app(app, host=settings.WEBAPP_HOST, port=settings.WEBAPP_PORT, reuse_port=settings.WEB_WORKERS > 1, print=None)
+
+def run_webhook():
+    if not settings.WEBHOOK_BASE_URL: logger.critical("BOT_MODE=webhook uchun WEBHOOK_BASE_URL kiritilmagan."); return
+    async def prepare(): await create_db_and_tables(); await engine.dispose()
+    asyncio.run(prepare())
+    if settings.WEB_WORKERS <= 1: return run_webhook_worker(0)
+    run_processes(run_webhook_worker, settings.WEB_WORKERS, "webhook-worker")
 
 if __name__ == "__main__":
-    try: asyncio.run(main())
+    try:
+        if settings.BOT_MODE.lower() == "webhook": run_webhook()
+        elif settings.BOT_MODE.lower() == "consumer": run_consumers()
+        else: asyncio.run(run_polling())
     except (KeyboardInterrupt, SystemExit): logger.info("Bot foydalanuvchi tomonidan to'xtatildi.")
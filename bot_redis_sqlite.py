@@ -1,8 +1,10 @@
 import asyncio
+import json
 import logging
 import os
 import random
-from typing import List, Union, Dict, Optional, Callable, Any, Awaitable
+from functools import partial
+from typing import List, Union, Dict, Optional, Callable, Any, Awaitable, Tuple, NamedTuple
 
 from aiogram import Bot, Dispatcher, F, BaseMiddleware, Router
 from aiogram.client.bot import DefaultBotProperties
@@ -20,8 +22,12 @@ from aiogram.filters.command import CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from sqlalchemy import (create_engine, Column, BigInteger, String, DateTime, ForeignKey, Integer, LargeBinary, UniqueConstraint, JSON, Boolean, Text, select, update, func)
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine, async_sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
 import redis.asyncio as aioredis
@@ -49,14 +55,26 @@ class Settings(BaseSettings):
     REDIS_PASSWORD: Optional[str] = None
     REDIS_DB_FSM: int = 0
     REDIS_DB_CAPTCHA: int = 1
+    FSM_STATE_TTL_SECONDS: int = 86400
+    FSM_DATA_TTL_SECONDS: int = 86400
     CAPTCHA_TIMEOUT_SECONDS: int = 60
     CAPTCHA_MAX_ATTEMPTS: int = 3
     CAPTCHA_BLOCK_DURATION_MINUTES: int = 5
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 268435456
+    SQLITE_CACHE_SIZE: int = -64000
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_WRITE_TIMEOUT_SECONDS: int = 60
+    SQLITE_READ_POOL_SIZE: int = 4
+    SQLITE_READ_MAX_OVERFLOW: int = 16
     @property
     def ADMIN_IDS(self) -> List[int]: return [int(i.strip()) for i in self.ADMIN_IDS_STR.split(',') if i.strip()]
     @property
     def DATABASE_URL(self) -> str: return f"sqlite+aiosqlite:///{os.path.join(BASE_DIR, self.DB_NAME)}"
     @property
+    def SQLITE_READ_URL(self) -> str: return f"sqlite+aiosqlite:///file:{os.path.join(BASE_DIR, self.DB_NAME)}?mode=ro&uri=true"
+    @property
     def REQUIRED_CHANNELS(self) -> List[Union[str, int]]:
         channels = [];
         if not self.REQUIRED_CHANNELS_STR: return []
@@ -75,6 +93,12 @@ except Exception as e:
     logger.critical(f".env faylini yuklashda xatolik: {e}. Majburiy maydonlarni tekshiring: BOT_TOKEN, ADMIN_IDS, ENCRYPTION_KEY."); exit(1)
 
 
+try: import orjson
+except ImportError: orjson = None
+
+def fsm_json_dumps(data: Any) -> str: return orjson.dumps(data).decode() if orjson else json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+fsm_json_loads = orjson.loads if orjson else json.loads
+
 class CryptoService:
     def __init__(self, key: SecretStr):
         try: self.fernet = Fernet(key.get_secret_value().encode())
@@ -89,7 +113,24 @@ Base = declarative_base()
 class User(Base): __tablename__ = "users"; id = Column(BigInteger, primary_key=True); username = Column(String); first_name = Column(String); phone_number_encrypted = Column(LargeBinary); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="user")
 class Poll(Base): __tablename__ = "polls"; id = Column(Integer, primary_key=True, autoincrement=True); question = Column(Text, nullable=False); options = Column(JSON, nullable=False); is_active = Column(Boolean, default=False); created_by_admin_id = Column(BigInteger, nullable=False); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="poll")
 class Vote(Base): __tablename__ = "votes"; id = Column(Integer, primary_key=True, autoincrement=True); user_id = Column(BigInteger, ForeignKey("users.id")); poll_id = Column(Integer, ForeignKey("polls.id")); choice_key = Column(String); created_at = Column(DateTime, server_default=func.now()); user = relationship("User", back_populates="votes"); poll = relationship("Poll", back_populates="votes"); __table_args__ = (UniqueConstraint('user_id', 'poll_id'),)
-engine = create_async_engine(settings.DATABASE_URL); AsyncSessionFactory = async_sessionmaker(engine, expire_on_commit=False)
+def apply_sqlite_pragmas(dbapi_connection, connection_record, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    if not read_only: cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    for pragma in (f"synchronous={settings.SQLITE_SYNCHRONOUS}", f"busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}", f"mmap_size={settings.SQLITE_MMAP_SIZE}", f"cache_size={settings.SQLITE_CACHE_SIZE}", *(("query_only=1",) if read_only else ())): cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, (UpdateBase, TextClause)): self.info["wrote"] = True
+        return (engine if self.info.get("wrote") or read_engine is engine else read_engine).sync_engine
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _reset_routing(session, transaction):
+    if transaction.parent is None: session.info.pop("wrote", None)
+def create_sqlite_engines() -> Tuple[AsyncEngine, AsyncEngine]:
+    writer = create_async_engine(settings.DATABASE_URL, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0, pool_timeout=settings.SQLITE_WRITE_TIMEOUT_SECONDS)
+    reader = create_async_engine(settings.SQLITE_READ_URL, poolclass=AsyncAdaptedQueuePool, pool_size=settings.SQLITE_READ_POOL_SIZE, max_overflow=settings.SQLITE_READ_MAX_OVERFLOW)
+    event.listen(writer.sync_engine, "connect", apply_sqlite_pragmas); event.listen(reader.sync_engine, "connect", partial(apply_sqlite_pragmas, read_only=True))
+    return writer, reader
+engine, read_engine = create_sqlite_engines(); AsyncSessionFactory = async_sessionmaker(engine, expire_on_commit=False, sync_session_class=RoutingSession)
 async def create_db_and_tables(): 
     async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all); logger.info("DB jadvallari yaratildi.")
 async def get_or_create_user(session: AsyncSession, user_id: int, username: str = None, first_name: str = None) -> User: r = await session.execute(select(User).where(User.id == user_id)); user = r.scalar_one_or_none();_ = user or (user := User(id=user_id, username=username, first_name=first_name), session.add(user), await session.commit(), await session.refresh(user)); return user
@@ -110,21 +151,31 @@ async def get_poll_results(session: AsyncSession, poll_id: int) -> Dict[str, int
 async def get_all_user_ids(session: AsyncSession) -> List[int]: return (await session.execute(select(User.id))).scalars().all()
 
 
+class CaptchaResult(NamedTuple): status: str; attempts_left: int
+
 class CaptchaService:
-    def __init__(self, redis_client: aioredis.Redis): self.redis = redis_client
+    VERIFY_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return {'blocked', 0} end
+local answer = redis.call('HGET', KEYS[1], 'answer')
+if not answer then return {'expired', 0} end
+if answer == ARGV[1] then redis.call('DEL', KEYS[1]); return {'correct', 0} end
+local left = tonumber(ARGV[2]) - redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+if left <= 0 then redis.call('SET', KEYS[2], '1', 'EX', ARGV[3]); redis.call('DEL', KEYS[1]); return {'exhausted', 0} end
+return {'wrong', left}
+"""
+    def __init__(self, redis_client: aioredis.Redis): self.redis = redis_client; self._verify = redis_client.register_script(self.VERIFY_SCRIPT)
     def _generate_math_captcha(self)->tuple[str,str]: n1,n2=random.randint(1,10),random.randint(1,10);ops={'+':n1+n2,'-':abs(n1-n2),'*':n1*n2};op=random.choice(list(ops.keys()));q_n1,q_n2=(n1,n2) if n1>=n2 else (n2,n1);q=f"{q_n1} {op} {q_n2} = ?";a=str(ops[op]);return q,a
-    async def create_captcha(self,user_id:int)->str: q,a=self._generate_math_captcha(); await self.redis.set(f"captcha:{user_id}:answer",a,ex=settings.CAPTCHA_TIMEOUT_SECONDS); await self.redis.set(f"captcha:{user_id}:attempts",0,ex=settings.CAPTCHA_TIMEOUT_SECONDS+10); return q
-    async def verify_captcha(self,user_id:int,user_answer:str)->bool:
-        correct_answer = await self.redis.get(f"captcha:{user_id}:answer")
-        if not correct_answer: return False
-        if correct_answer == user_answer.strip(): await self.redis.delete(f"captcha:{user_id}:answer", f"captcha:{user_id}:attempts"); return True
-        else:
-            attempts = await self.redis.incr(f"captcha:{user_id}:attempts")
-            if attempts >= settings.CAPTCHA_MAX_ATTEMPTS: await self.redis.set(f"captcha_block:{user_id}","1",ex=settings.CAPTCHA_BLOCK_DURATION_MINUTES*60); await self.redis.delete(f"captcha:{user_id}:answer", f"captcha:{user_id}:attempts")
-            return False
+    async def create_captcha(self,user_id:int)->str:
+        q,a=self._generate_math_captcha()
+        async with self.redis.pipeline(transaction=True) as pipe: pipe.delete(f"captcha:{user_id}"); pipe.hset(f"captcha:{user_id}", mapping={"answer": a, "attempts": 0}); pipe.expire(f"captcha:{user_id}", settings.CAPTCHA_TIMEOUT_SECONDS); await pipe.execute()
+        return q
+    async def check_captcha(self, user_id: int, user_answer: str) -> CaptchaResult:
+        status, attempts_left = await self._verify(keys=[f"captcha:{user_id}", f"captcha_block:{user_id}"], args=[user_answer.strip(), settings.CAPTCHA_MAX_ATTEMPTS, settings.CAPTCHA_BLOCK_DURATION_MINUTES*60])
+        return CaptchaResult(status, int(attempts_left))
+    async def verify_captcha(self,user_id:int,user_answer:str)->bool: return (await self.check_captcha(user_id, user_answer)).status == "correct"
     async def is_user_blocked(self, user_id: int) -> bool: return await self.redis.exists(f"captcha_block:{user_id}")
     async def get_attempts_left(self, user_id: int) -> int:
-        attempts = await self.redis.get(f"captcha:{user_id}:attempts")
+        attempts = await self.redis.hget(f"captcha:{user_id}", "attempts")
         return settings.CAPTCHA_MAX_ATTEMPTS - int(attempts) if attempts else settings.CAPTCHA_MAX_ATTEMPTS
 
 
@@ -279,8 +330,8 @@ async def cmd_start(message: Message, state: FSMContext, session: AsyncSession,
     if unsubscribed_channels: await message.answer("Assalomu alaykum! Ishtirok etish uchun kanallarga a'zo bo'ling:", reply_markup=get_channel_subscription_keyboard(unsubscribed_channels)); await state.set_state(VotingProcess.awaiting_subscription_check)
     else: await message.answer("Assalomu alaykum! Ovoz berish uchun telefon raqamingizni yuboring:", reply_markup=get_contact_keyboard()); await state.set_state(VotingProcess.awaiting_contact)
 
-async def process_deep_link_vote(message: Message, session: AsyncSession, bot: Bot, poll_id: int, choice_key: str):
-    user_id = message.from_user.id; poll = await get_poll_by_id(session, poll_id)
+async def process_deep_link_vote(message: Message, session: AsyncSession, bot: Bot, poll_id: int, choice_key: str, user_id: Optional[int] = None):
+    user_id = user_id or message.from_user.id; poll = await get_poll_by_id(session, poll_id)
     if not poll or not poll.is_active: return await message.answer("Afsuski, bu so'rovnoma aktiv emas.")
     if await has_user_voted(session, user_id, poll_id): return await message.answer("Siz bu so'rovnomada allaqon ovoz bergansiz.")
     unsubscribed_channels = await check_all_channels_membership(bot, user_id)
@@ -298,7 +349,7 @@ async def cb_check_subscription(callback_query: CallbackQuery, state: FSMContext
     else:
         await callback_query.message.delete(); data = await state.get_data(); deep_link_vote = data.get('deep_link_vote')
         if deep_link_vote:
-            poll_id, choice_key = deep_link_vote; await process_deep_link_vote(callback_query.message, session, bot, poll_id, choice_key); await state.clear(); return
+            poll_id, choice_key = deep_link_vote; await process_deep_link_vote(callback_query.message, session, bot, poll_id, choice_key, callback_query.from_user.id); await state.clear(); return
         await callback_query.message.answer("Rahmat! Endi telefon raqamingizni yuboring:", reply_markup=get_contact_keyboard()); await state.set_state(VotingProcess.awaiting_contact)
 @user_router.message(F.contact, VotingProcess.awaiting_contact)
 async def handle_contact(message: Message, state: FSMContext, session: AsyncSession, crypto_service: CryptoService, captcha_service: CaptchaService):
@@ -310,16 +361,16 @@ async def invalid_contact_input(message: Message): await message.reply("Iltimos,
 @user_router.message(VotingProcess.awaiting_captcha)
 async def process_captcha_answer(message: Message, state: FSMContext, session: AsyncSession, captcha_service: CaptchaService):
     user_id = message.from_user.id
-    if await captcha_service.is_user_blocked(user_id): await message.answer("Siz vaqtinchalik bloklangansiz."); await state.clear(); return
-    is_correct = await captcha_service.verify_captcha(user_id, message.text)
-    if is_correct:
+    result = await captcha_service.check_captcha(user_id, message.text or "")
+    if result.status == "blocked": await message.answer("Siz vaqtinchalik bloklangansiz."); await state.clear(); return
+    if result.status == "correct":
         await message.answer("✅ To'g'ri!"); active_poll = await get_active_poll(session)
         if not active_poll: await message.answer("Hozircha aktiv so'rovnomalar yo'q."); await state.clear(); return
         if await has_user_voted(session, user_id, active_poll.id): await message.answer("Siz bu so'rovnomada allaqachon ovoz bergansiz."); await state.clear(); return
         await message.answer(f"So'rovnoma:\n<b>{active_poll.question}</b>\n\nVariantni tanlang:", reply_markup=get_poll_options_keyboard(active_poll)); await state.set_state(VotingProcess.awaiting_vote_choice)
-    else:
-        if await captcha_service.is_user_blocked(user_id): await message.answer(f"Noto'g'ri. Urinishlar tugadi. Siz {settings.CAPTCHA_BLOCK_DURATION_MINUTES} daqiqaga bloklandingiz."); await state.clear()
-        else: attempts_left = await captcha_service.get_attempts_left(user_id); await message.answer(f"Noto'g'ri. Yana {attempts_left} ta urinish qoldi.")
+    elif result.status == "exhausted": await message.answer(f"Noto'g'ri. Urinishlar tugadi. Siz {settings.CAPTCHA_BLOCK_DURATION_MINUTES} daqiqaga bloklandingiz."); await state.clear()
+    elif result.status == "expired": await message.answer("CAPTCHA vaqti tugadi. Qaytadan boshlash uchun /start bosing."); await state.clear()
+    else: await message.answer(f"Noto'g'ri. Yana {result.attempts_left} ta urinish qoldi.")
 
 @user_router.callback_query(F.data.startswith("vote_poll:"), VotingProcess.awaiting_vote_choice)
 async def process_vote_choice(callback_query: CallbackQuery, state: FSMContext, session: AsyncSession, bot: Bot):
@@ -347,7 +398,7 @@ async def main():
     redis_fsm_client = aioredis.Redis(db=settings.REDIS_DB_FSM, decode_responses=True, **redis_connection_params)
     redis_captcha_client = aioredis.Redis(db=settings.REDIS_DB_CAPTCHA, decode_responses=True, **redis_connection_params)
     
-    storage = RedisStorage(redis=redis_fsm_client)
+    storage = RedisStorage(redis=redis_fsm_client, state_ttl=settings.FSM_STATE_TTL_SECONDS, data_ttl=settings.FSM_DATA_TTL_SECONDS, json_dumps=fsm_json_dumps, json_loads=fsm_json_loads)
     captcha_service = CaptchaService(redis_client=redis_captcha_client)
     crypto_service = CryptoService(settings.ENCRYPTION_KEY)
     
@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+parser = argparse.ArgumentParser(description="bot_postgress_sql.py uchun Telegram'siz yuklama testi (SQLite + lokal Redis).")
+parser.add_argument("--users", type=int, default=500, help="Sintetik foydalanuvchilar soni")
+parser.add_argument("--deep-link-users", type=int, default=200, help="Deep link orqali ovoz beradigan foydalanuvchilar soni")
+parser.add_argument("--concurrency", type=int, default=100, help="Bir vaqtda ishlaydigan foydalanuvchilar")
+parser.add_argument("--unsubscribed", type=float, default=0.3, help="Avval kanalga a'zo bo'lmagan foydalanuvchilar ulushi")
+parser.add_argument("--channels", type=int, default=2, help="Majburiy kanallar soni")
+parser.add_argument("--latency-ms", type=float, default=40.0, help="Soxta Bot API javob kechikishi")
+parser.add_argument("--jitter-ms", type=float, default=20.0, help="Kechikishga qo'shiladigan tasodifiy qism")
+parser.add_argument("--rate-429", type=float, default=0.0, help="So'rovlarning qancha qismi 429 (RetryAfter) bilan qaytadi")
+parser.add_argument("--retry-after", type=int, default=1, help="429 javobidagi retry_after soniyalari")
+parser.add_argument("--broadcast", action="store_true", help="Oxirida /send_ad reklamasini ham yuborish")
+parser.add_argument("--write-behind", action="store_true", help="VOTE_WRITE_BEHIND_ENABLED bilan ishlatish")
+parser.add_argument("--throttle", action="store_true", help="ThrottlingMiddleware'ni yoqib qoldirish")
+parser.add_argument("--redis-db", type=int, default=13, help="Test uchun ishlatiladigan (va tozalanadigan) Redis bazalari boshlanishi: N, N+1, N+2")
+args = parser.parse_args()
+
+ADMIN_ID = 1
+CHANNEL_IDS = [-1001000000000 - i for i in range(args.channels)]
+workdir = tempfile.mkdtemp(prefix="loadtest_")
+
+from cryptography.fernet import Fernet
+
+os.environ.update({
+    "BOT_TOKEN": "123456:LOADTEST-fake-token", "ENCRYPTION_KEY": Fernet.generate_key().decode(), "ADMIN_IDS": str(ADMIN_ID),
+    "REQUIRED_CHANNELS": ",".join(str(ch) for ch in CHANNEL_IDS), "DB_TYPE": "sqlite", "SQLITE_DB_NAME": os.path.join(workdir, "loadtest.db"),
+    "REDIS_DB_FSM": str(args.redis_db), "REDIS_DB_CAPTCHA": str(args.redis_db + 1), "REDIS_DB_CACHE": str(args.redis_db + 2),
+    "BOT_MODE": "polling", "METRICS_ENABLED": "False", "THROTTLE_ENABLED": str(args.throttle), "VOTE_WRITE_BEHIND_ENABLED": str(args.write_behind),
+    "BROADCAST_PROGRESS_INTERVAL_SECONDS": "1",
+})
+
+import bot_postgress_sql as app
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from sqlalchemy import func, select
+from aiogram.types import Chat, ChatMemberLeft, ChatMemberMember, InlineKeyboardMarkup, Message, TelegramObject, Update, User
+
+class FakeTelegramSession(BaseSession):
+    def __init__(self, latency: float, jitter: float, rate_429: float, retry_after: int):
+        super().__init__()
+        self.latency = latency; self.jitter = jitter; self.rate_429 = rate_429; self.retry_after = retry_after
+        self.message_ids = itertools.count(1); self.calls: Dict[str, int] = defaultdict(int); self.retry_afters = 0
+        self.joined: Set[int] = set(); self.unsubscribed: Set[int] = set(); self.markups: Dict[int, InlineKeyboardMarkup] = {}
+    async def close(self): pass
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True):
+        yield b""
+    async def make_request(self, bot: Bot, method: Any, timeout: Optional[int] = None) -> Any:
+        name = method.__api_method__; self.calls[name] += 1
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+        if self.rate_429 and random.random() < self.rate_429:
+            self.retry_afters += 1; raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=self.retry_after)
+        return self._result(name, method)
+    def _result(self, name: str, method: Any) -> Any:
+        if name == "getMe": return User(id=123456, is_bot=True, first_name="LoadTest", username="loadtest_bot")
+        if name == "getChat": return Chat(id=int(method.chat_id), type="channel", title=f"Kanal {method.chat_id}", invite_link=f"https://t.me/+{abs(int(method.chat_id))}")
+        if name == "getChatMember":
+            user = User(id=method.user_id, is_bot=False, first_name=f"user{method.user_id}")
+            return ChatMemberLeft(user=user) if method.user_id in self.unsubscribed and method.user_id not in self.joined else ChatMemberMember(user=user)
+        if name in ("sendMessage", "sendPhoto", "editMessageText"):
+            chat_id = int(method.chat_id)
+            if isinstance(getattr(method, "reply_markup", None), InlineKeyboardMarkup): self.markups[chat_id] = method.reply_markup
+            return Message(message_id=next(self.message_ids), date=datetime.now(), chat=Chat(id=chat_id, type="private"), text=getattr(method, "text", None))
+        return True
+
+class HandlerTimer(BaseMiddleware):
+    def __init__(self): self.samples: Dict[str, List[float]] = defaultdict(list)
+    async def __call__(self, handler: Callable, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        try: return await handler(event, data)
+        finally: self.samples[data["handler"].callback.__name__].append(time.perf_counter() - started)
+
+class LoadGenerator:
+    def __init__(self, bot: Bot, dp: Any, fake: FakeTelegramSession):
+        self.bot = bot; self.dp = dp; self.fake = fake; self.update_ids = itertools.count(1); self.updates = 0
+        self.update_samples: Dict[str, List[float]] = defaultdict(list); self.vote_attempts = 0; self.failures: Dict[str, int] = defaultdict(int)
+    def _user(self, user_id: int) -> Dict[str, Any]: return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    def _message(self, user_id: int, **fields: Any) -> Dict[str, Any]:
+        return {"message_id": next(self.update_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), **fields}
+    async def feed(self, step: str, payload: Dict[str, Any]):
+        update = Update.model_validate({"update_id": next(self.update_ids), **payload}, context={"bot": self.bot})
+        started = time.perf_counter(); await self.dp.feed_update(self.bot, update)
+        self.update_samples[step].append(time.perf_counter() - started); self.updates += 1
+    async def send_text(self, step: str, user_id: int, text: str): await self.feed(step, {"message": self._message(user_id, text=text)})
+    async def press(self, step: str, user_id: int, data: str):
+        message = {"message_id": next(self.update_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": {"id": 123456, "is_bot": True, "first_name": "LoadTest"}, "text": "..."}
+        await self.feed(step, {"callback_query": {"id": str(next(self.update_ids)), "from": self._user(user_id), "chat_instance": str(user_id), "data": data, "message": message}})
+    async def check_subscription(self, user_id: int):
+        if user_id in self.fake.unsubscribed: self.fake.joined.add(user_id); await self.press("check_subscription", user_id, "check_subscription")
+    async def full_flow(self, user_id: int):
+        await self.send_text("start", user_id, "/start"); await self.check_subscription(user_id)
+        await self.feed("contact", {"message": self._message(user_id, contact={"phone_number": f"+99890{user_id:07d}", "first_name": f"user{user_id}", "user_id": user_id})})
+        answer = await self.dp["captcha_service"].redis.hget(f"captcha:{user_id}", "answer")
+        await self.send_text("captcha", user_id, answer or "0")
+        markup = self.fake.markups.get(user_id)
+        choices = [b.callback_data for row in (markup.inline_keyboard if markup else []) for b in row if (b.callback_data or "").startswith("vote_poll:")]
+        if choices: await self.press("vote", user_id, random.choice(choices)); self.vote_attempts += 1
+    async def deep_link_vote(self, user_id: int, poll_id: int, choice_key: str):
+        await self.send_text("deep_link", user_id, f"/start v_{poll_id}_{choice_key}"); await self.check_subscription(user_id); self.vote_attempts += 1
+    async def broadcast(self) -> float:
+        await self.send_text("send_ad", ADMIN_ID, "/send_ad"); await self.send_text("send_ad", ADMIN_ID, "Yuklama testi reklamasi")
+        await self.feed("send_ad", {"message": self._message(ADMIN_ID, photo=[{"file_id": "loadtest-photo", "file_unique_id": "loadtest", "width": 1, "height": 1}])})
+        started = time.perf_counter(); await self.send_text("send_ad", ADMIN_ID, "ha")
+        engine: app.BroadcastEngine = self.dp["broadcast_engine"]
+        while engine.tasks: await asyncio.sleep(0.1)
+        return time.perf_counter() - started
+
+async def count_recorded_votes(poll_id: int, user_ids: List[int]) -> Tuple[int, int]:
+    deadline = time.monotonic() + 30
+    while await app.vote_ingestor.backlog() and time.monotonic() < deadline: await asyncio.sleep(0.2)
+    async with app.AsyncSessionFactory() as session:
+        total = await session.scalar(select(func.count()).select_from(app.Vote).where(app.Vote.poll_id == poll_id))
+        stray = await session.scalar(select(func.count()).select_from(app.Vote).where(app.Vote.poll_id == poll_id, app.Vote.user_id.not_in(user_ids)))
+    return total - stray, stray
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples); return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000 if ordered else 0.0
+
+def print_table(title: str, samples: Dict[str, List[float]]):
+    print(f"\n{title}\n{'nomi':<28}{'soni':>8}{'p50 ms':>10}{'p99 ms':>10}{'maks ms':>10}")
+    for name, values in sorted(samples.items()): print(f"{name:<28}{len(values):>8}{percentile(values, 0.5):>10.1f}{percentile(values, 0.99):>10.1f}{max(values) * 1000:>10.1f}")
+
+async def run():
+    fake = FakeTelegramSession(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_429, args.retry_after)
+    await app.create_db_and_tables()
+    for db in (args.redis_db, args.redis_db + 1, args.redis_db + 2):
+        client = app.create_redis_client(db); await client.flushdb(); await client.close()
+    bot, dp = app.build_dispatcher(session=fake); timer = HandlerTimer()
+    for observer in (dp.message, dp.callback_query): observer.middleware(timer)
+    await dp.emit_startup(dispatcher=dp, **dp.workflow_data)
+    try:
+        async with app.AsyncSessionFactory() as session: poll = await app.create_poll(session, "Yuklama testi", {"1": "A", "2": "B", "3": "C"}, ADMIN_ID, is_active=True)
+        user_ids = list(range(1000, 1000 + args.users)); deep_link_ids = list(range(10_000_000, 10_000_000 + args.deep_link_users))
+        fake.unsubscribed = set(random.sample(user_ids + deep_link_ids, int((len(user_ids) + len(deep_link_ids)) * args.unsubscribed)))
+        generator = LoadGenerator(bot, dp, fake); semaphore = asyncio.Semaphore(args.concurrency)
+        async def guarded(job: Callable[[], Any]):
+            async with semaphore:
+                try: await job()
+                except Exception as e: generator.failures[f"{job.func.__name__}: {type(e).__name__}"] += 1
+        jobs = [partial(generator.full_flow, uid) for uid in user_ids] + [partial(generator.deep_link_vote, uid, poll.id, random.choice(["1", "2", "3"])) for uid in deep_link_ids]
+        random.shuffle(jobs); started = time.perf_counter()
+        await asyncio.gather(*(guarded(job) for job in jobs)); elapsed = time.perf_counter() - started
+        recorded, stray = await count_recorded_votes(poll.id, user_ids + deep_link_ids)
+        print(f"\n{generator.updates} update {elapsed:.2f}s ichida: {generator.updates / elapsed:.1f} update/s, 429 javoblar: {fake.retry_afters}")
+        print(f"Ovozlar (bazadan): {recorded} yozildi, {generator.vote_attempts - recorded} urinish muvaffaqiyatsiz ({generator.vote_attempts} urinishdan), boshqa user_id ostida yozilgan: {stray}")
+        if generator.failures: print(f"Xato bilan tugagan foydalanuvchi oqimlari: {sum(generator.failures.values())} ta (" + ", ".join(f"{name}={count}" for name, count in sorted(generator.failures.items())) + ")")
+        print_table("Update bo'yicha (feed_update, oxiridan oxirigacha):", generator.update_samples)
+        print_table("Handler bo'yicha:", timer.samples)
+        if args.broadcast:
+            duration = await generator.broadcast(); sent = fake.calls["sendPhoto"] - 1
+            print(f"\nReklama: {sent} ta xabar {duration:.2f}s ichida ({sent / duration:.1f} xabar/s)")
+        print("\nBot API chaqiruvlari: " + ", ".join(f"{name}={count}" for name, count in sorted(fake.calls.items())))
+        if vote_ingestor_backlog := await app.vote_ingestor.backlog(): print(f"Yozilishi kutilayotgan ovozlar (hisobga kirmagan): {vote_ingestor_backlog}")
+        if stray: print(f"\nXATO: {stray} ta ovoz sintetik foydalanuvchilarga tegishli bo'lmagan user_id ostida yozildi."); return 1
+        return 1 if generator.failures else 0
+    finally:
+        await dp.emit_shutdown(dispatcher=dp, **dp.workflow_data)
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(run()))
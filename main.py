@@ -1,9 +1,12 @@
 import asyncio
+import heapq
 import logging
 import os
 import random
 import time
-from typing import List, Union, Dict, Optional, Callable, Any, Awaitable, Tuple
+from collections import OrderedDict
+from functools import partial
+from typing import List, Union, Dict, Optional, Callable, Any, Awaitable, Tuple, NamedTuple
 
 from aiogram import Bot, Dispatcher, F, BaseMiddleware, Router
 from aiogram.client.bot import DefaultBotProperties
@@ -12,7 +15,7 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, Teleg
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.types import (
     Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, TelegramObject
@@ -21,8 +24,12 @@ from aiogram.filters.command import CommandObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from sqlalchemy import (create_engine, Column, BigInteger, String, DateTime, ForeignKey, Integer, LargeBinary, UniqueConstraint, JSON, Boolean, Text, select, update, func)
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine, async_sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
 from cryptography.fernet import Fernet, InvalidToken
@@ -40,9 +47,24 @@ class AppSettings:
     CAPTCHA_TIMEOUT_SECONDS: int = 60
     CAPTCHA_MAX_ATTEMPTS: int = 3
     CAPTCHA_BLOCK_DURATION_MINUTES: int = 5
+    CAPTCHA_STORE_MAX_ENTRIES: int = 100000
+    CAPTCHA_SWEEP_INTERVAL_SECONDS: int = 30
+    FSM_MAX_KEYS: int = 100000
+    FSM_TTL_SECONDS: int = 86400
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_MMAP_SIZE: int = 268435456
+    SQLITE_CACHE_SIZE: int = -64000
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_WRITE_TIMEOUT_SECONDS: int = 60
+    SQLITE_READ_POOL_SIZE: int = 4
+    SQLITE_READ_MAX_OVERFLOW: int = 16
     @property
     def DATABASE_URL(self) -> str:
         base_dir = os.path.dirname(os.path.abspath(__file__)); db_path = os.path.join(base_dir, self.DB_NAME); return f"sqlite+aiosqlite:///{db_path}"
+    @property
+    def SQLITE_READ_URL(self) -> str:
+        base_dir = os.path.dirname(os.path.abspath(__file__)); db_path = os.path.join(base_dir, self.DB_NAME); return f"sqlite+aiosqlite:///file:{db_path}?mode=ro&uri=true"
 settings = AppSettings()
 
 
@@ -60,7 +82,24 @@ Base = declarative_base()
 class User(Base): __tablename__ = "users"; id = Column(BigInteger, primary_key=True); username = Column(String); first_name = Column(String); phone_number_encrypted = Column(LargeBinary); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="user")
 class Poll(Base): __tablename__ = "polls"; id = Column(Integer, primary_key=True, autoincrement=True); question = Column(Text, nullable=False); options = Column(JSON, nullable=False); is_active = Column(Boolean, default=False); created_by_admin_id = Column(BigInteger, nullable=False); created_at = Column(DateTime, server_default=func.now()); votes = relationship("Vote", back_populates="poll")
 class Vote(Base): __tablename__ = "votes"; id = Column(Integer, primary_key=True, autoincrement=True); user_id = Column(BigInteger, ForeignKey("users.id")); poll_id = Column(Integer, ForeignKey("polls.id")); choice_key = Column(String); created_at = Column(DateTime, server_default=func.now()); user = relationship("User", back_populates="votes"); poll = relationship("Poll", back_populates="votes"); __table_args__ = (UniqueConstraint('user_id', 'poll_id'),)
-engine = create_async_engine(settings.DATABASE_URL); AsyncSessionFactory = async_sessionmaker(engine, expire_on_commit=False)
+def apply_sqlite_pragmas(dbapi_connection, connection_record, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    if not read_only: cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    for pragma in (f"synchronous={settings.SQLITE_SYNCHRONOUS}", f"busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}", f"mmap_size={settings.SQLITE_MMAP_SIZE}", f"cache_size={settings.SQLITE_CACHE_SIZE}", *(("query_only=1",) if read_only else ())): cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, (UpdateBase, TextClause)): self.info["wrote"] = True
+        return (engine if self.info.get("wrote") or read_engine is engine else read_engine).sync_engine
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _reset_routing(session, transaction):
+    if transaction.parent is None: session.info.pop("wrote", None)
+def create_sqlite_engines() -> Tuple[AsyncEngine, AsyncEngine]:
+    writer = create_async_engine(settings.DATABASE_URL, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0, pool_timeout=settings.SQLITE_WRITE_TIMEOUT_SECONDS)
+    reader = create_async_engine(settings.SQLITE_READ_URL, poolclass=AsyncAdaptedQueuePool, pool_size=settings.SQLITE_READ_POOL_SIZE, max_overflow=settings.SQLITE_READ_MAX_OVERFLOW)
+    event.listen(writer.sync_engine, "connect", apply_sqlite_pragmas); event.listen(reader.sync_engine, "connect", partial(apply_sqlite_pragmas, read_only=True))
+    return writer, reader
+engine, read_engine = create_sqlite_engines(); AsyncSessionFactory = async_sessionmaker(engine, expire_on_commit=False, sync_session_class=RoutingSession)
 async def create_db_and_tables(): 
     async with engine.begin() as conn: await conn.run_sync(Base.metadata.create_all); logger.info("DB jadvallari yaratildi.")
 async def get_or_create_user(s: AsyncSession, u_id: int, u: str = None, f_n: str = None) -> User:
@@ -85,27 +124,81 @@ async def get_all_user_ids(session: AsyncSession) -> List[int]: # <-- OMMIVIY XA
     result = await session.execute(select(User.id))
     return result.scalars().all()
 
+class CaptchaResult(NamedTuple): status: str; attempts_left: int
+
+class TTLStore:
+    def __init__(self, max_size: int): self.max_size = max_size; self.data: Dict[int, Tuple[Any, float]] = {}; self.heap: List[Tuple[float, int]] = []
+    def __len__(self) -> int: return len(self.data)
+    def set(self, key: int, value: Any, ttl: float):
+        expires = time.monotonic() + ttl; self.data[key] = (value, expires); heapq.heappush(self.heap, (expires, key))
+        while len(self.data) > self.max_size: self._pop_earliest()
+        if len(self.heap) > 2 * len(self.data) + 1024: self.heap = [(exp, k) for k, (_, exp) in self.data.items()]; heapq.heapify(self.heap)
+    def get(self, key: int) -> Any:
+        item = self.data.get(key)
+        if item is None: return None
+        if item[1] <= time.monotonic(): self.data.pop(key, None); return None
+        return item[0]
+    def pop(self, key: int): self.data.pop(key, None)
+    def _pop_earliest(self) -> Optional[float]:
+        while self.heap:
+            expires, key = heapq.heappop(self.heap); item = self.data.get(key)
+            if item is not None and item[1] == expires: del self.data[key]; return expires
+        return None
+    def sweep(self) -> int:
+        now, removed = time.monotonic(), 0
+        while self.heap and self.heap[0][0] <= now:
+            expires, key = heapq.heappop(self.heap); item = self.data.get(key)
+            if item is not None and item[1] == expires: del self.data[key]; removed += 1
+        return removed
+
 class CaptchaServiceMemory:
-    def __init__(self): self.captchas: Dict[int, Tuple[str, float]] = {}; self.attempts: Dict[int, Tuple[int, float]] = {}; self.block_list: Dict[int, float] = {}
-    def _cleanup_user(self, u_id:int): self.captchas.pop(u_id, None); self.attempts.pop(u_id, None)
+    def __init__(self): self.captchas = TTLStore(settings.CAPTCHA_STORE_MAX_ENTRIES); self.block_list = TTLStore(settings.CAPTCHA_STORE_MAX_ENTRIES)
     def _generate_math_captcha(self)->tuple[str,str]: n1,n2=random.randint(1,10),random.randint(1,10);ops={'+':n1+n2,'-':abs(n1-n2),'*':n1*n2};op=random.choice(list(ops.keys()));q_n1,q_n2=(n1,n2) if n1>=n2 else (n2,n1);q=f"{q_n1} {op} {q_n2} = ?";a=str(ops[op]);return q,a
-    async def create_captcha(self,u_id:int)->str: q,a=self._generate_math_captcha();t=time.time();self.captchas[u_id]=(a,t);self.attempts[u_id]=(0,t);return q
-    async def verify_captcha(self,u_id:int,u_a:str)->bool:
-        if u_id not in self.captchas: return False
-        ans, c_time = self.captchas[u_id]
-        if time.time()-c_time > settings.CAPTCHA_TIMEOUT_SECONDS: self._cleanup_user(u_id); return False
-        if ans == u_a.strip(): self._cleanup_user(u_id); return True
-        else:
-            a_made,_=self.attempts.get(u_id,(0,0));a_made+=1;self.attempts[u_id]=(a_made,c_time)
-            if a_made >= settings.CAPTCHA_MAX_ATTEMPTS: self.block_list[u_id]=time.time()+settings.CAPTCHA_BLOCK_DURATION_MINUTES*60;self._cleanup_user(u_id)
-            return False
-    async def is_user_blocked(self,u_id:int)->bool:
-        if u_id in self.block_list:
-            if time.time() < self.block_list[u_id]: return True
-            else: self.block_list.pop(u_id, None)
-        return False
-    async def get_attempts_left(self,u_id:int)->int: a_made,_=self.attempts.get(u_id,(0,0));return settings.CAPTCHA_MAX_ATTEMPTS-a_made
-
+    async def create_captcha(self,u_id:int)->str: q,a=self._generate_math_captcha();self.captchas.set(u_id,[a,0],settings.CAPTCHA_TIMEOUT_SECONDS);return q
+    async def check_captcha(self, u_id: int, u_a: str) -> CaptchaResult:
+        if self.block_list.get(u_id): return CaptchaResult("blocked", 0)
+        state = self.captchas.get(u_id)
+        if state is None: return CaptchaResult("expired", 0)
+        if state[0] == u_a.strip(): self.captchas.pop(u_id); return CaptchaResult("correct", 0)
+        state[1] += 1; left = settings.CAPTCHA_MAX_ATTEMPTS - state[1]
+        if left <= 0: self.block_list.set(u_id, True, settings.CAPTCHA_BLOCK_DURATION_MINUTES*60); self.captchas.pop(u_id); return CaptchaResult("exhausted", 0)
+        return CaptchaResult("wrong", left)
+    async def verify_captcha(self,u_id:int,u_a:str)->bool: return (await self.check_captcha(u_id, u_a)).status == "correct"
+    async def is_user_blocked(self,u_id:int)->bool: return bool(self.block_list.get(u_id))
+    async def get_attempts_left(self,u_id:int)->int: state=self.captchas.get(u_id);return settings.CAPTCHA_MAX_ATTEMPTS-(state[1] if state else 0)
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(settings.CAPTCHA_SWEEP_INTERVAL_SECONDS); removed = self.captchas.sweep() + self.block_list.sweep()
+            if removed: logger.info(f"CAPTCHA xotirasi tozalandi: {removed} ta yozuv o'chirildi ({len(self.captchas)} captcha, {len(self.block_list)} blok qoldi).")
+
+class BoundedMemoryStorage(BaseStorage):
+    def __init__(self, max_keys: int, ttl: float): self.max_keys = max_keys; self.ttl = ttl; self.records: "OrderedDict[StorageKey, Tuple[Optional[str], Dict[str, Any], float]]" = OrderedDict()
+    def _get(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any]]:
+        record = self.records.get(key)
+        if record is None: return None, {}
+        if record[2] <= time.monotonic(): del self.records[key]; return None, {}
+        self.records[key] = (record[0], record[1], time.monotonic() + self.ttl); self.records.move_to_end(key); return record[0], record[1]
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        if state is None and not data: self.records.pop(key, None); return
+        self.records[key] = (state, data, time.monotonic() + self.ttl); self.records.move_to_end(key)
+        while len(self.records) > self.max_keys: self.records.popitem(last=False)
+    async def set_state(self, key: StorageKey, state: StateType = None): _, data = self._get(key); self._put(key, state.state if isinstance(state, State) else state, data)
+    async def get_state(self, key: StorageKey) -> Optional[str]: return self._get(key)[0]
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]): state, _ = self._get(key); self._put(key, state, data.copy())
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]: return self._get(key)[1].copy()
+    async def close(self): self.records.clear()
+    def sweep(self) -> int:
+        now, removed = time.monotonic(), 0
+        while self.records:
+            key, record = next(iter(self.records.items()))
+            if record[2] > now: break
+            del self.records[key]; removed += 1
+        return removed
+
+async def run_fsm_sweeper(storage: BoundedMemoryStorage):
+    while True:
+        await asyncio.sleep(settings.CAPTCHA_SWEEP_INTERVAL_SECONDS); removed = storage.sweep()
+        if removed: logger.info(f"FSM xotirasi tozalandi: {removed} ta eskirgan holat o'chirildi ({len(storage.records)} qoldi).")
 
 class VotingProcess(StatesGroup): awaiting_subscription_check=State();awaiting_contact=State();awaiting_captcha=State();awaiting_vote_choice=State()
 class AdminPollManagement(StatesGroup): awaiting_poll_question=State();awaiting_poll_options=State()
@@ -287,16 +380,16 @@ async def invalid_contact_input(m: Message): await m.reply("Iltimos, 'Telefon ra
 @user_router.message(VotingProcess.awaiting_captcha)
 async def process_captcha_answer(m: Message, state: FSMContext, s: AsyncSession, captcha: CaptchaServiceMemory):
     u_id = m.from_user.id
-    if await captcha.is_user_blocked(u_id): await m.answer("Siz vaqtinchalik bloklangansiz."); await state.clear(); return
-    is_corr=await captcha.verify_captcha(u_id,m.text)
-    if is_corr:
+    res=await captcha.check_captcha(u_id,m.text or "")
+    if res.status=="blocked": await m.answer("Siz vaqtinchalik bloklangansiz."); await state.clear(); return
+    if res.status=="correct":
         await m.answer("✅ To'g'ri!");ap=await get_active_poll(s)
         if not ap:await m.answer("Hozircha aktiv so'rovnomalar yo'q.");await state.clear();return
         if await has_user_voted(s,u_id,ap.id):await m.answer("Siz bu so'rovnomada allaqachon ovoz bergansiz.");await state.clear();return
         await m.answer(f"So'rovnoma:\n<b>{ap.question}</b>\n\nVariantni tanlang:",reply_markup=get_poll_options_keyboard(ap));await state.set_state(VotingProcess.awaiting_vote_choice)
-    else:
-        if await captcha.is_user_blocked(u_id):await m.answer(f"Noto'g'ri. Urinishlar tugadi. Siz {settings.CAPTCHA_BLOCK_DURATION_MINUTES} daqiqaga bloklandingiz.");await state.clear()
-        else:att_left=await captcha.get_attempts_left(u_id);await m.answer(f"Noto'g'ri. Yana {att_left} ta urinish qoldi.")
+    elif res.status=="exhausted":await m.answer(f"Noto'g'ri. Urinishlar tugadi. Siz {settings.CAPTCHA_BLOCK_DURATION_MINUTES} daqiqaga bloklandingiz.");await state.clear()
+    elif res.status=="expired":await m.answer("CAPTCHA vaqti tugadi. Qaytadan boshlash uchun /start bosing.");await state.clear()
+    else:await m.answer(f"Noto'g'ri. Yana {res.attempts_left} ta urinish qoldi.")
 
 @user_router.callback_query(F.data.startswith("vote_poll:"),VotingProcess.awaiting_vote_choice)
 async def process_vote_choice(c: CallbackQuery, state: FSMContext, s: AsyncSession, bot: Bot):
@@ -319,16 +412,19 @@ async def process_vote_choice(c: CallbackQuery, state: FSMContext, s: AsyncSessi
 
 
 async def main():
-    storage=MemoryStorage();captcha_service=CaptchaServiceMemory();crypto_service=CryptoService(settings.ENCRYPTION_KEY)
+    storage=BoundedMemoryStorage(settings.FSM_MAX_KEYS,settings.FSM_TTL_SECONDS);captcha_service=CaptchaServiceMemory();crypto_service=CryptoService(settings.ENCRYPTION_KEY)
     bot=Bot(token=settings.BOT_TOKEN,default=DefaultBotProperties(parse_mode=ParseMode.HTML));dp=Dispatcher(storage=storage)
     dp.update.middleware(DbSessionMiddleware(pool=AsyncSessionFactory))
     dp.workflow_data.update({"crypto_service":crypto_service,"captcha_service":captcha_service,"bot":bot})
     dp.include_router(admin_router);dp.include_router(user_router)
     await create_db_and_tables()
     logger.info("Bot ishga tushirilmoqda (ommaviy xabar yuborish funksiyasi bilan)...")
+    sweepers=[asyncio.create_task(captcha_service.run_sweeper()),asyncio.create_task(run_fsm_sweeper(storage))]
     try: await bot.delete_webhook(drop_pending_updates=True); await dp.start_polling(bot)
     except Exception as e: logger.critical(f"Botni ishga tushirishda xatolik: {e}", exc_info=True)
-    finally: await bot.session.close(); logger.info("Bot to'xtatildi.")
+    finally:
+        for t in sweepers: t.cancel()
+        await bot.session.close(); logger.info("Bot to'xtatildi.")
 
 if __name__ == "__main__":
     try: asyncio.run(main())